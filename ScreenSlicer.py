@@ -1,34 +1,42 @@
 import sys
-import subprocess
-import webbrowser
-
-# Check and install required modules
-required_modules = {
-    'PyQt5': 'PyQt5',
-    'PIL': 'Pillow',
-    'screeninfo': 'screeninfo'  # For getting display info from Windows
-}
+import time
 
-for module, pip_name in required_modules.items():
-    try:
-        __import__(module)
-    except ImportError:
-        print(f"Module {module} not found. Installing...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", pip_name])
-
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QLineEdit, QPushButton,
-                             QVBoxLayout, QHBoxLayout, QMessageBox, QDialog, QComboBox, QWidget,
-                             QFileDialog, QScrollArea, QToolTip)
-from PyQt5.QtGui import QPixmap, QPainter, QColor, QBrush, QPen, QRegion, QFont
-from PyQt5.QtCore import Qt, QRect, QPoint, QSize
-from PIL import Image
-import math
-import platform
+# Startup timeline, printed by --profile-startup
+startup_marks = [('start', time.perf_counter())]
 
+def markStartup(label):
+    startup_marks.append((label, time.perf_counter()))
+
+# Headless commands run before any Qt import so they work without a display
+HEADLESS_COMMANDS = ('slice', 'watch', 'serve', 'diagnose', 'cache')
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] in HEADLESS_COMMANDS:
+    import slicing
+    sys.exit(slicing.main(sys.argv[1:]))
+
+# Only what is needed to show the window is imported here. Pillow, NumPy and
+# screeninfo are loaded on first use; 'ScreenSlicer.py diagnose' checks them.
 try:
-    from screeninfo import get_monitors
+    from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QLineEdit, QPushButton,
+                                 QVBoxLayout, QHBoxLayout, QMessageBox, QDialog, QComboBox, QWidget,
+                                 QFileDialog, QScrollArea, QToolTip, QProgressDialog, QSpinBox, QCheckBox,
+                                 QInputDialog)
+    from PyQt5.QtGui import QPainter, QColor, QBrush, QPen, QRegion, QFont, QImage, QImageReader
+    from PyQt5.QtCore import (Qt, QRect, QRectF, QPoint, QSize, QTimer, QElapsedTimer, QObject, QRunnable,
+                              QThreadPool, QBuffer, QByteArray, pyqtSignal)
+    from PyQt5 import sip
 except ImportError:
-    get_monitors = None  # In case screeninfo is not available
+    print('PyQt5 is not installed. Run: python ScreenSlicer.py diagnose --install', file=sys.stderr)
+    sys.exit(1)
+markStartup('import PyQt5')
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import math
+import os
+import platform
+import threading
+import slicing
+markStartup('import stdlib and slicing')
 
 class ScreenConfigDialog(QDialog):
     def __init__(self, existing_screens=None):
@@ -165,14 +173,223 @@ class ScreenConfigDialog(QDialog):
             return False
         return True
 
+SOURCE_QIMAGE_FORMATS = {
+    'L': QImage.Format_Grayscale8,
+    'RGBX': QImage.Format_RGBX8888,
+    'RGBA': QImage.Format_RGBA8888,
+}
+
+def sourceQImage(source):
+    # Wraps the decoded buffer without copying; only valid while source lives
+    return arrayQImage(source.pixels, source.mode)
+
+def arrayQImage(pixels, mode):
+    return QImage(sip.voidptr(pixels.ctypes.data), pixels.shape[1], pixels.shape[0],
+                  pixels.strides[0], SOURCE_QIMAGE_FORMATS[mode])
+
+def displayFormat(image):
+    # Formats the raster paint engine blits without per-paint conversion
+    return QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+
+def grayscaleImage(image):
+    return image.convertToFormat(QImage.Format_Grayscale8).convertToFormat(QImage.Format_RGB32)
+
+def encodeImage(image, image_format, quality=-1):
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QBuffer.WriteOnly)
+    image.save(buffer, image_format, quality)
+    return bytes(data)
+
+class ProxyPyramid:
+    # Display-resolution proxies of the source image, halved level by level.
+    # Level 0 is never larger than max_side pixels on its long side, so memory
+    # is bounded by the preview size rather than by the source size or zoom.
+    # Levels are QImages so that background scale jobs can read them.
+    MIN_SIDE = 64
+
+    def __init__(self, image, source_size, max_side):
+        self.source_size = source_size
+        if max(image.width(), image.height()) > max_side:
+            image = image.scaled(max_side, max_side, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        image = image.convertToFormat(displayFormat(image))
+        self.levels = [image]
+        while max(image.width(), image.height()) // 2 >= self.MIN_SIDE:
+            image = image.scaled(image.width() // 2, image.height() // 2,
+                                 Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.levels.append(image)
+        self.grayscale = [None] * len(self.levels)
+
+    @classmethod
+    def fromSource(cls, source, max_side):
+        # Start from the smallest proxy stored by the decode cache that is
+        # still large enough, so a memory-mapped source is not read in full
+        for proxy in reversed(source.proxies):
+            if max(proxy.shape[:2]) >= max_side:
+                return cls(arrayQImage(proxy, source.mode), QSize(*source.size), max_side)
+        return cls(sourceQImage(source), QSize(*source.size), max_side)
+
+    def levelFor(self, scale):
+        # Smallest level that still has at least one texel per device pixel
+        index = 0
+        for idx, level in enumerate(self.levels):
+            if level.width() / self.source_size.width() >= scale:
+                index = idx
+            else:
+                break
+        return index
+
+    def levelGrayscale(self, index):
+        if self.grayscale[index] is None:
+            self.grayscale[index] = grayscaleImage(self.levels[index])
+        return self.grayscale[index]
+
+    def detailProxy(self):
+        # Smallest level at least DETAIL_PROXY_SIDE on its long side, as a
+        # grayscale array for the detail fit
+        import numpy as np
+
+        image = self.levels[0]
+        for level in self.levels:
+            if max(level.width(), level.height()) >= slicing.DETAIL_PROXY_SIDE:
+                image = level
+        image = image.convertToFormat(QImage.Format_Grayscale8)
+        bits = image.constBits()
+        bits.setsize(image.bytesPerLine() * image.height())
+        rows = np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine())
+        return rows[:, :image.width()].copy()
+
+class ScaleJobSignals(QObject):
+    finished = pyqtSignal(int, QImage, QImage)
+
+class ScaleJob(QRunnable):
+    # Smooth-scales a proxy level to the exact on-screen size off the GUI thread
+    def __init__(self, generation, image, size):
+        super().__init__()
+        self.generation = generation
+        self.image = image
+        self.size = size
+        self.signals = ScaleJobSignals()
+
+    def run(self):
+        with slicing.tracer.span('smooth scale', 'preview', width=self.size.width(), height=self.size.height()):
+            scaled = self.image.scaled(self.size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            scaled_bw = grayscaleImage(scaled)
+        self.signals.finished.emit(self.generation, scaled, scaled_bw)
+
+class LoadJobSignals(QObject):
+    preview = pyqtSignal(int, object)  # ProxyPyramid of a quick preview
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str, str)
+
+class LoadJob(QRunnable):
+    # Loads an image for the preview off the GUI thread. Quick previews come
+    # first: the EXIF thumbnail, then for JPEG a DCT-scaled decode at about
+    # the proxy size. The full decode (kept in the source cache for export)
+    # and its proxy pyramid follow. A superseded load stops at the next stage.
+    def __init__(self, generation, image_path, max_side):
+        super().__init__()
+        self.generation = generation
+        self.image_path = image_path
+        self.max_side = max_side
+        self.cancel = threading.Event()
+        self.signals = LoadJobSignals()
+
+    def run(self):
+        try:
+            with slicing.tracer.span('load', 'preview', path=self.image_path):
+                reader = QImageReader(self.image_path)
+                source_size = reader.size()
+                cached = slicing.decode_cache is not None and slicing.decode_cache.has(self.image_path)
+                if source_size.isValid() and not cached:
+                    self.quickPreviews(reader, source_size)
+                if self.cancel.is_set():
+                    return
+                source = slicing.source_cache.get(self.image_path)
+                if self.cancel.is_set():
+                    return
+                with slicing.tracer.span('build pyramid', 'preview'):
+                    pyramid = ProxyPyramid.fromSource(source, self.max_side)
+            self.signals.finished.emit(self.generation, pyramid)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, self.image_path, str(e))
+
+    def quickPreviews(self, reader, source_size):
+        with slicing.tracer.span('thumbnail', 'preview'):
+            try:
+                thumbnail = slicing.exif_thumbnail(self.image_path)
+            except Exception:
+                thumbnail = None  # Damaged EXIF data only costs the quick preview
+            image = QImage.fromData(thumbnail) if thumbnail else QImage()
+        self.emitPreview(image, source_size)
+        # The full proxy replaces the draft, so it only needs to be about
+        # the widget size: a cheaper DCT scale that is still sharp on screen
+        draft_side = self.max_side // PreviewWidget.PROXY_OVERSAMPLE
+        if reader.format() != b'jpeg' or max(source_size.width(), source_size.height()) <= draft_side:
+            return  # Only JPEG decodes at a reduced size for free
+        if self.cancel.is_set():
+            return
+        with slicing.tracer.span('draft decode', 'preview'):
+            reader.setScaledSize(source_size.scaled(draft_side, draft_side, Qt.KeepAspectRatio))
+            image = reader.read()
+        self.emitPreview(image, source_size)
+
+    def emitPreview(self, image, source_size):
+        if not image.isNull() and not self.cancel.is_set():
+            self.signals.preview.emit(self.generation, ProxyPyramid(image, source_size, self.max_side))
+
+class StageTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        self.profiler.recordStage(self.name, self.start, time.perf_counter_ns())
+
+class PaintProfiler:
+    # Recent paint timings for the profiling overlay; every paint and paint
+    # stage is also recorded as a trace span
+    WINDOW = 60  # Frames averaged per stage
+
+    def __init__(self):
+        self.paints = deque(maxlen=240)  # (end time, duration) in ns
+        self.stages = {}
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def recordStage(self, name, start, end):
+        self.stages.setdefault(name, deque(maxlen=self.WINDOW)).append(end - start)
+        slicing.tracer.record(name, 'paint', start, end, {})
+
+    def recordPaint(self, start, end):
+        self.paints.append((end, end - start))
+        slicing.tracer.record('paint', 'paint', start, end, {})
+
+    def lines(self):
+        if not self.paints:
+            return ['No frames painted yet']
+        last = self.paints[-1][0]
+        rate = sum(1 for end, _ in self.paints if last - end < 1e9)
+        average = sum(duration for _, duration in self.paints) / len(self.paints)
+        lines = [f'Frame {self.paints[-1][1] / 1e6:.1f} ms (avg {average / 1e6:.1f} ms)',
+                 f'Repaints {rate}/s']
+        for name, durations in self.stages.items():
+            lines.append(f'  {name:<14} {sum(durations) / len(durations) / 1e6:6.2f} ms')
+        return lines
+
 class PreviewWidget(QWidget):
-    def __init__(self, screen_arrangement, screen_resolutions, screen_physical_sizes):
+    PROXY_OVERSAMPLE = 2  # Level 0 covers this many times the widget size
+    DISPLAY_MAX_AREA = 4  # Largest smooth display image, in widget areas
+    loadFailed = pyqtSignal(str, str)  # Image path, error
+
+    def __init__(self, screens=None):
         super().__init__()
-        self.screen_arrangement = screen_arrangement  # List of screen positions and sizes
-        self.screen_resolutions = screen_resolutions
-        self.screen_physical_sizes = screen_physical_sizes
-        self.image = None
-        self.original_image = None
+        self.screens = screens  # slicing.ScreenGeometry, positions in preview pixels
+        self.pyramid = None
         self.image_position = QPoint(0, 0)
         self.dragging_image = False
         self.dragging_screen = False
@@ -181,74 +398,193 @@ class PreviewWidget(QWidget):
         self.screens_defined = False
         self.image_loaded = False
         self.image_scale = 1.0  # Added for image scaling
+        # Render cache, rebuilt only when the image or the screens change
+        self.screen_region = None
+        self.coverage = None
+        self.coverage_key = None
+        self.painted_coverage = None
+        # Drags and nudges are coalesced into at most one repaint per frame
+        self.pending_region = QRegion()
+        self.pending_image = False
+        self.pending_screen = None
+        self.frame_clock = QElapsedTimer()
+        self.frame_clock.start()
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.flushRepaint)
+        # Smooth image at the exact on-screen size, computed in the background
+        self.display_image = None
+        self.display_bw = None
+        self.display_size = None
+        self.scale_pool = QThreadPool(self)
+        self.scale_pool.setMaxThreadCount(1)
+        self.scale_generation = 0
+        self.scale_job = None
+        self.scale_job_size = None
+        # Background image loading; a new load cancels the previous one
+        self.load_pool = QThreadPool(self)
+        self.load_pool.setMaxThreadCount(2)  # A new preview need not wait for a cancelled decode
+        self.load_generation = 0
+        self.load_job = None
+        self.load_placement = None
+        self.shown_generation = None
+        # PaintProfiler while the profiling overlay is on
+        self.profiler = None
         self.initUI()
 
     def initUI(self):
         self.setMinimumSize(800, 600)
         self.setStyleSheet('background-color: #FFFFFF;')
         self.setMouseTracking(True)
+        self.setFocusPolicy(Qt.StrongFocus)  # Arrow keys nudge the image
         QToolTip.setFont(QFont('SansSerif', 10))
 
-    def setImage(self, image_path):
-        self.original_image = QPixmap(image_path)
-        self.image = self.original_image.copy()
+    def invalidateScreenCache(self):
+        # Call whenever a screen is added, removed or moved
+        self.screen_region = None
+        self.coverage_key = None
+
+    def proxyMaxSide(self):
+        side = max(self.width(), self.height(), self.minimumWidth(), self.minimumHeight())
+        return int(side * self.devicePixelRatioF() * self.PROXY_OVERSAMPLE)
+
+    def setImage(self, image_path, placement=None):
+        # Loads in the background (see LoadJob); the decoded source is kept
+        # once per session and export reuses the same buffer. placement
+        # (x, y, scale) is applied when the first preview appears.
+        self.cancelLoad()
+        self.load_generation += 1
+        self.load_placement = placement
+        self.load_job = LoadJob(self.load_generation, image_path, self.proxyMaxSide())
+        self.load_job.signals.preview.connect(self.loadPreview)
+        self.load_job.signals.finished.connect(self.loadFinished)
+        self.load_job.signals.failed.connect(self.loadError)
+        self.load_pool.start(self.load_job)
+
+    def cancelLoad(self):
+        if self.load_job is not None:
+            self.load_job.cancel.set()
+            self.load_job = None
+        self.load_pool.clear()
+        self.load_generation += 1  # Results still on their way are ignored
+
+    def isLoading(self):
+        return self.load_job is not None
+
+    def loadPreview(self, generation, pyramid):
+        if generation == self.load_generation:
+            self.showPyramid(generation, pyramid)
+
+    def loadFinished(self, generation, pyramid):
+        if generation == self.load_generation:
+            self.load_job = None
+            self.showPyramid(generation, pyramid)
+
+    def loadError(self, generation, image_path, error):
+        if generation == self.load_generation:
+            self.load_job = None
+            self.loadFailed.emit(image_path, error)
+
+    def showPyramid(self, generation, pyramid):
+        # The first image of a load places it; sharper ones replace it in place
+        self.pyramid = pyramid
+        if generation == self.shown_generation:
+            self.pyramidChanged()
+            return
+        self.shown_generation = generation
+        self.imageChanged()
+        if self.load_placement is not None:
+            self.image_position = QPoint(self.load_placement['x'], self.load_placement['y'])
+            self.image_scale = self.load_placement['scale']
+
+    def setProxy(self, image, source_size):
+        # Preview from an image already reduced for display, such as the
+        # proxy embedded in a session; the source is decoded only on export
+        self.cancelLoad()
+        self.pyramid = ProxyPyramid(image, source_size, self.proxyMaxSide())
+        self.imageChanged()
+
+    def imageChanged(self):
         self.image_loaded = True
         self.image_position = QPoint(0, 0)
         self.image_scale = 1.0  # Reset scale when a new image is loaded
+        self.pyramidChanged()
+
+    def pyramidChanged(self):
+        self.display_image = None
+        self.display_bw = None
+        self.display_size = None
+        self.scale_generation += 1  # Smooth scales of the old proxy are stale
+        self.scale_job_size = None
         self.update()
 
+    def imageSize(self):
+        # Size of the placed image in preview coordinates
+        source_size = self.pyramid.source_size
+        return QSize(*slicing.placed_size((source_size.width(), source_size.height()), self.image_scale))
+
+    def imageRect(self):
+        return QRect(self.image_position, self.imageSize())
+
     def scaleImage(self, factor):
         if self.image_loaded:
-            self.image_scale *= factor
-            width = int(self.original_image.width() * self.image_scale)
-            height = int(self.original_image.height() * self.image_scale)
-            self.image = self.original_image.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.update()
+            with slicing.tracer.span('scale', 'preview', factor=factor):
+                self.image_scale *= factor
+                self.update()
         else:
             QMessageBox.warning(self, 'No Image', 'Please load an image before scaling.')
 
-    def fitImageToScreens(self):
+    def fitImageToScreens(self, objective='cover'):
         if self.image_loaded and self.screens_defined:
-            # Calculate the bounding rectangle of all screens
-            screens_rect = self.calculateScreensBoundingRect()
-            # Calculate the scaling factor needed to fit the image over the screens
-            image_rect = QRect(0, 0, self.original_image.width(), self.original_image.height())
-
-            # Calculate scale factors for width and height
-            scale_w = screens_rect.width() / image_rect.width()
-            scale_h = screens_rect.height() / image_rect.height()
-            # Choose the maximum scale that fits the image inside the screens
-            scale_factor = max(scale_w, scale_h)
-
-            # Update image scale
-            self.image_scale = scale_factor
-            self.image = self.original_image.scaled(
-                int(self.original_image.width() * self.image_scale),
-                int(self.original_image.height() * self.image_scale),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation
-            )
-
-            # Center the image over the screens
-            self.image_position = QPoint(
-                screens_rect.left() - (self.image.width() - screens_rect.width()) // 2,
-                screens_rect.top() - (self.image.height() - screens_rect.height()) // 2
-            )
+            # Solve the scale and position over the exact screen union in one step
+            source_size = self.pyramid.source_size
+            image_size = self.imageSize()
+            center = (self.image_position.x() + image_size.width() / 2,
+                      self.image_position.y() + image_size.height() / 2)
+            with slicing.tracer.span('fit', 'preview', objective=objective, screens=len(self.screens)):
+                proxy = self.pyramid.detailProxy() if objective == 'detail' else None
+                placement = slicing.solve_placement(self.screens, (source_size.width(), source_size.height()),
+                                                    objective, center, proxy)
+            self.image_scale = placement['scale']
+            self.image_position = QPoint(placement['x'], placement['y'])
             self.update()
         else:
             QMessageBox.warning(self, 'No Image or Screens', 'Please load an image and define screens before fitting.')
 
     def calculateScreensBoundingRect(self):
         # Calculate the bounding rectangle that contains all screens
-        if not self.screen_arrangement:
+        if not self.screens:
             return QRect()
-        rect = QRect(self.screen_arrangement[0]['pos'], self.screen_arrangement[0]['size'])
-        for screen in self.screen_arrangement[1:]:
-            screen_rect = QRect(screen['pos'], screen['size'])
-            rect = rect.united(screen_rect)
-        return rect
+        return QRect(*self.screens.bounds())
+
+    def screenRect(self, idx):
+        return QRect(*self.screens.rect(idx))
+
+    def cachedScreenRegion(self):
+        if self.screen_region is None:
+            screen_region = QRegion()
+            for rect in (self.screens.rects() if self.screens else []):
+                screen_region = screen_region.united(QRegion(*rect))
+            self.screen_region = screen_region
+        return self.screen_region
+
+    def cachedCoverage(self):
+        # Coverage only changes when the image rect or the screens change
+        image_rect = self.imageRect()
+        key = (image_rect.x(), image_rect.y(), image_rect.width(), image_rect.height())
+        if self.coverage_key != key:
+            self.coverage = self.screens.coverage(key) if self.screens else None
+            self.coverage_key = key
+        return self.coverage
+
+    def stage(self, name):
+        # Times a part of paintEvent when profiling
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name)
 
     def paintEvent(self, event):
+        paint_start = time.perf_counter_ns()
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing)
 
@@ -256,37 +592,53 @@ class PreviewWidget(QWidget):
         painter.translate(self.offset)
         painter.scale(self.scale_factor, self.scale_factor)
 
-        # Draw the background image (black and white, more opaque outside screens)
-        if self.image:
-            # Create a grayscale version of the image
-            image_bw = self.image.toImage().convertToFormat(3)  # QImage.Format_Grayscale8
-            image_bw_pixmap = QPixmap.fromImage(image_bw)
-            painter.setOpacity(0.5)
-            painter.drawPixmap(self.image_position, image_bw_pixmap)
-            painter.setOpacity(1.0)
-
-        # Create a clipping region for the screens
-        screen_region = QRegion()
-        for screen in self.screen_arrangement:
-            rect = QRect(screen['pos'], screen['size'])
-            screen_region = screen_region.united(QRegion(rect))
-
-        # Clip to the screens and draw the image
-        if self.image:
-            painter.setClipRegion(screen_region)
-            painter.drawPixmap(self.image_position, self.image)
-            painter.setClipping(False)
+        if self.pyramid:
+            target = QRectF(self.imageRect())
+            with self.stage('select image'):
+                if self.display_image is not None and self.display_size == self.displaySize():
+                    # Smooth image already at the on-screen size: a plain blit
+                    image, image_bw = self.display_image, self.display_bw
+                else:
+                    # Fast transform from the closest proxy level until the
+                    # smooth version arrives (or always, when zoomed in so far
+                    # that an exact-size image would be too large)
+                    level = self.pyramid.levelFor(self.image_scale * self.scale_factor * self.devicePixelRatioF())
+                    image, image_bw = self.pyramid.levels[level], self.pyramid.levelGrayscale(level)
+                    if not self.requestSmoothScale(level):
+                        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+
+            # Draw the background image (black and white, more opaque outside screens)
+            with self.stage('grayscale'):
+                painter.setOpacity(0.5)
+                painter.drawImage(target, image_bw, QRectF(image_bw.rect()))
+                painter.setOpacity(1.0)
+
+            # Clip to the screens and draw the image
+            with self.stage('clipped image'):
+                painter.setClipRegion(self.cachedScreenRegion())
+                painter.drawImage(target, image, QRectF(image.rect()))
+                painter.setClipping(False)
+
+        with self.stage('screens'):
+            self.paintScreens(painter, event.rect())
+
+        painter.restore()
+        if self.profiler is not None:
+            self.profiler.recordPaint(paint_start, time.perf_counter_ns())
+            self.paintOverlay(painter)
 
+    def paintScreens(self, painter, rect):
         # Draw screens with red border if not fully covered
-        for idx, screen in enumerate(self.screen_arrangement):
-            rect = QRect(screen['pos'], screen['size'])
+        coverage = self.cachedCoverage() if self.pyramid else None
+        self.painted_coverage = coverage
+        # Only the screens inside the repainted area are drawn
+        exposed = self.previewRect(rect)
+        visible = self.screens.query(*exposed) if self.screens else []
+        for idx in visible:
+            rect = self.screenRect(idx)
             # Check if the image fully covers the screen
-            if self.image:
-                image_rect = QRect(self.image_position, self.image.size())
-                if image_rect.contains(rect):
-                    pen_color = Qt.black
-                else:
-                    pen_color = Qt.red
+            if coverage is not None:
+                pen_color = Qt.black if coverage[idx] else Qt.red
             else:
                 pen_color = Qt.black
             painter.setPen(QPen(pen_color, 2 / self.scale_factor))  # Adjust pen width
@@ -294,34 +646,143 @@ class PreviewWidget(QWidget):
             painter.drawRect(rect)
             painter.drawText(rect, Qt.AlignCenter, f"Screen {idx+1}")
 
-        painter.restore()
+    def overlayRect(self):
+        return QRect(10, 10, 240, 16 * (3 + len(self.profiler.stages)) + 10)
+
+    def paintOverlay(self, painter):
+        # Live frame timings in the top-left corner, in widget coordinates
+        rect = self.overlayRect()
+        painter.setOpacity(0.75)
+        painter.fillRect(rect, Qt.black)
+        painter.setOpacity(1.0)
+        painter.setPen(Qt.white)
+        painter.setFont(QFont('Monospace', 9))
+        for row, line in enumerate(self.profiler.lines()):
+            painter.drawText(rect.adjusted(8, 5 + 16 * row, -8, 0), Qt.AlignLeft | Qt.AlignTop, line)
+
+    def displaySize(self):
+        # On-screen size of the image in device pixels
+        image_size = self.imageSize()
+        ratio = self.scale_factor * self.devicePixelRatioF()
+        return QSize(max(1, round(image_size.width() * ratio)), max(1, round(image_size.height() * ratio)))
+
+    def requestSmoothScale(self, level):
+        # Starts (or keeps) a background job for the current display size.
+        # Returns False when the size is too large to prepare in advance.
+        size = self.displaySize()
+        widget_area = self.width() * self.height() * self.devicePixelRatioF() ** 2
+        if size.width() * size.height() > self.DISPLAY_MAX_AREA * widget_area:
+            return False
+        if self.scale_job_size == size:
+            return True  # Already being computed
+        # A newer request supersedes queued jobs; running ones are ignored
+        self.scale_pool.clear()
+        self.scale_generation += 1
+        self.scale_job_size = size
+        self.scale_job = ScaleJob(self.scale_generation, self.pyramid.levels[level], size)
+        self.scale_job.signals.finished.connect(self.smoothScaleFinished)
+        self.scale_pool.start(self.scale_job)
+        return True
+
+    def smoothScaleFinished(self, generation, image, image_bw):
+        if generation != self.scale_generation:
+            return  # Stale: the scale changed while this job was running
+        self.display_image = image
+        self.display_bw = image_bw
+        self.display_size = image.size()
+        self.scale_job = None
+        self.scale_job_size = None
+        self.update()
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
             pos = (event.pos() - self.offset) / self.scale_factor
             if self.image_loaded:
-                image_rect = QRect(self.image_position, self.image.size())
-                if self.image and image_rect.contains(pos):
+                if self.imageRect().contains(pos):
                     self.dragging_image = True
                     self.drag_start_pos = pos - self.image_position
-            else:
+            elif self.screens:
                 # Allow moving screens before image is loaded
-                for screen in reversed(self.screen_arrangement):
-                    rect = QRect(screen['pos'], screen['size'])
-                    if rect.contains(pos):
-                        self.dragging_screen = True
-                        self.selected_screen = screen
-                        self.drag_start_pos = pos - screen['pos']
-                        break
+                idx = self.screens.hit_test(pos.x(), pos.y())
+                if idx is not None:
+                    self.dragging_screen = True
+                    self.selected_screen = idx
+                    self.drag_start_pos = pos - self.screenRect(idx).topLeft()
 
     def mouseMoveEvent(self, event):
         pos = (event.pos() - self.offset) / self.scale_factor
         if self.dragging_image:
+            self.scheduleRepaint(self.imageRect())
             self.image_position = pos - self.drag_start_pos
-            self.update()
+            self.pending_image = True
         elif self.dragging_screen:
-            self.selected_screen['pos'] = pos - self.drag_start_pos
-            self.update()
+            self.scheduleRepaint(self.screenRect(self.selected_screen))
+            new_pos = pos - self.drag_start_pos
+            self.screens.move(self.selected_screen, new_pos.x(), new_pos.y())
+            self.pending_screen = self.selected_screen
+            self.invalidateScreenCache()
+
+    def keyPressEvent(self, event):
+        step = 10 if event.modifiers() & Qt.ShiftModifier else 1
+        moves = {Qt.Key_Left: (-step, 0), Qt.Key_Right: (step, 0), Qt.Key_Up: (0, -step), Qt.Key_Down: (0, step)}
+        if event.key() in moves and self.image_loaded:
+            self.moveImage(*moves[event.key()])
+        else:
+            super().keyPressEvent(event)
+
+    def widgetRect(self, rect):
+        # Preview rect in widget pixels, grown to cover the screen borders
+        mapped = QRectF(rect.x() * self.scale_factor + self.offset.x(),
+                        rect.y() * self.scale_factor + self.offset.y(),
+                        rect.width() * self.scale_factor,
+                        rect.height() * self.scale_factor)
+        return mapped.toAlignedRect().adjusted(-2, -2, 2, 2)
+
+    def previewRect(self, rect):
+        # Widget rect in preview coordinates as (x, y, width, height)
+        mapped = QRectF((rect.x() - self.offset.x()) / self.scale_factor,
+                        (rect.y() - self.offset.y()) / self.scale_factor,
+                        rect.width() / self.scale_factor,
+                        rect.height() / self.scale_factor).toAlignedRect()
+        return mapped.x(), mapped.y(), mapped.width(), mapped.height()
+
+    def frameInterval(self):
+        screen = self.screen()
+        refresh_rate = screen.refreshRate() if screen else 60
+        return int(1000 / (refresh_rate if refresh_rate > 0 else 60))
+
+    def scheduleRepaint(self, old_rect):
+        # old_rect is what is currently on screen for the moving item. Only
+        # the first event of a frame records it; later ones were never shown.
+        if self.frame_timer.isActive():
+            return
+        self.pending_region = self.pending_region.united(QRegion(self.widgetRect(old_rect)))
+        wait = self.frameInterval() - self.frame_clock.elapsed()
+        self.frame_timer.start(max(0, wait))
+
+    def flushRepaint(self):
+        # Repaint the union of the old and new rectangles of what moved, plus
+        # any screen whose covered/uncovered border colour flips
+        region = self.pending_region
+        if self.pending_image and self.pyramid:
+            region = region.united(QRegion(self.widgetRect(self.imageRect())))
+            coverage = self.cachedCoverage()
+            if coverage is None:
+                pass
+            elif self.painted_coverage is not None and len(self.painted_coverage) == len(coverage):
+                for idx in (coverage != self.painted_coverage).nonzero()[0].tolist():
+                    region = region.united(QRegion(self.widgetRect(self.screenRect(idx))))
+            else:
+                region = QRegion(self.rect())
+        if self.pending_screen is not None:
+            region = region.united(QRegion(self.widgetRect(self.screenRect(self.pending_screen))))
+        if self.profiler is not None:
+            region = region.united(QRegion(self.overlayRect()))  # Keep the overlay live
+        self.pending_region = QRegion()
+        self.pending_image = False
+        self.pending_screen = None
+        self.frame_clock.restart()
+        self.update(region)
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton:
@@ -355,14 +816,17 @@ class PreviewWidget(QWidget):
     # Methods for fine adjustment
     def moveImage(self, dx, dy):
         if self.image_loaded:
+            self.scheduleRepaint(self.imageRect())
             self.image_position += QPoint(dx, dy)
-            self.update()
+            self.pending_image = True
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, profile=False):
         super().__init__()
         self.app_name = 'ScreenSlicer'  # Original and short name for the app
         self.setWindowTitle(self.app_name)
+        self.screens = None  # slicing.ScreenGeometry once screens are configured
+        self.profile = profile  # Profiling overlay and trace recording
         self.initUI()
 
     def initUI(self):
@@ -478,12 +942,22 @@ class MainWindow(QMainWindow):
         fit_btn.setToolTip('Automatically fit the image over the screens')
         scale_layout.addWidget(fit_btn)
 
+        self.fit_combo = QComboBox()
+        self.fit_combo.addItem('Cover all screens', 'cover')
+        self.fit_combo.addItem('Show whole image', 'contain')
+        self.fit_combo.addItem('Balance cover and crop', 'balanced')
+        self.fit_combo.addItem('Keep image center', 'center')
+        self.fit_combo.addItem('Keep detail off bezels', 'detail')
+        self.fit_combo.setToolTip('What Try to Fit optimizes')
+        scale_layout.addWidget(self.fit_combo)
+
         main_layout.addLayout(controls_layout)
         main_layout.addLayout(scale_layout)
         main_layout.addLayout(fine_adjust_layout)
 
         # Preview area
-        self.preview_widget = PreviewWidget([], [], [])
+        self.preview_widget = PreviewWidget()
+        self.preview_widget.loadFailed.connect(self.imageLoadFailed)
         main_layout.addWidget(self.preview_widget)
 
         # Image input
@@ -498,11 +972,100 @@ class MainWindow(QMainWindow):
         image_layout.addWidget(self.load_image_btn)
         main_layout.addLayout(image_layout)
 
-        # Export button
+        # Export button and worker count
+        export_layout = QHBoxLayout()
         self.export_btn = QPushButton('Export')
         self.export_btn.clicked.connect(self.exportImages)
         self.export_btn.setToolTip('Export sliced images for each screen')
-        main_layout.addWidget(self.export_btn)
+        export_layout.addWidget(self.export_btn, 1)
+        self.profiles_btn = QPushButton('Export Profiles...')
+        self.profiles_btn.clicked.connect(self.exportProfiles)
+        self.profiles_btn.setToolTip('Export the image for several saved layouts and output resolutions at once')
+        export_layout.addWidget(self.profiles_btn)
+        export_layout.addWidget(QLabel('Workers:'))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, 64)
+        self.workers_spin.setValue(os.cpu_count() or 1)
+        self.workers_spin.setToolTip('Number of screens cropped and encoded in parallel')
+        export_layout.addWidget(self.workers_spin)
+        export_layout.addWidget(QLabel('Memory (MB):'))
+        self.memory_spin = QSpinBox()
+        self.memory_spin.setRange(0, 1024 * 1024)
+        self.memory_spin.setSpecialValueText('Unlimited')
+        self.memory_spin.setToolTip('Read the source in bands within this budget instead of decoding it fully')
+        export_layout.addWidget(self.memory_spin)
+        main_layout.addLayout(export_layout)
+
+        # Output format and encoder options
+        output_layout = QHBoxLayout()
+        output_layout.addWidget(QLabel('Format:'))
+        self.format_combo = QComboBox()
+        self.format_combo.addItem('JPEG', 'jpeg')
+        self.format_combo.addItem('PNG', 'png')
+        self.format_combo.addItem('WebP', 'webp')
+        self.format_combo.currentIndexChanged.connect(self.updateEncoderControls)
+        output_layout.addWidget(self.format_combo)
+        output_layout.addWidget(QLabel('Quality:'))
+        self.quality_spin = QSpinBox()
+        self.quality_spin.setRange(1, 100)
+        self.quality_spin.setValue(slicing.ENCODERS['jpeg'][2]['quality'])
+        self.quality_spin.setToolTip('JPEG and WebP quality')
+        output_layout.addWidget(self.quality_spin)
+        self.progressive_check = QCheckBox('Progressive')
+        self.progressive_check.setToolTip('Progressive JPEG, shown coarse first while loading')
+        output_layout.addWidget(self.progressive_check)
+        self.subsampling_combo = QComboBox()
+        for subsampling in slicing.JPEG_SUBSAMPLING:
+            self.subsampling_combo.addItem(subsampling, subsampling)
+        self.subsampling_combo.setCurrentIndex(self.subsampling_combo.findData('4:2:0'))
+        self.subsampling_combo.setToolTip('JPEG chroma subsampling; 4:4:4 keeps fine coloured text sharp')
+        output_layout.addWidget(self.subsampling_combo)
+        self.lossless_check = QCheckBox('Lossless')
+        self.lossless_check.setToolTip('Lossless WebP')
+        self.lossless_check.toggled.connect(self.updateEncoderControls)
+        output_layout.addWidget(self.lossless_check)
+        output_layout.addWidget(QLabel('Max size (KB):'))
+        self.target_spin = QSpinBox()
+        self.target_spin.setRange(0, 1024 * 1024)
+        self.target_spin.setSpecialValueText('Off')
+        self.target_spin.setToolTip('Pick the best quality per screen that fits in this size')
+        output_layout.addWidget(self.target_spin)
+        output_layout.addStretch(1)
+        main_layout.addLayout(output_layout)
+        self.updateEncoderControls()
+        self.export_pool = None
+        self.export_futures = []
+        self.export_saved = []
+        self.export_cancel = None
+        self.export_manifest = None
+        self.export_frame_dirs = []
+        self.export_timer = QTimer(self)
+        self.export_timer.setInterval(50)
+        self.export_timer.timeout.connect(self.pollExport)
+
+        # Save layout for headless slicing, and sessions to resume work
+        files_layout = QHBoxLayout()
+        self.save_layout_btn = QPushButton('Save Layout')
+        self.save_layout_btn.clicked.connect(self.saveLayout)
+        self.save_layout_btn.setToolTip('Save the screens and image placement for command-line slicing')
+        files_layout.addWidget(self.save_layout_btn)
+        save_session_btn = QPushButton('Save Session')
+        save_session_btn.clicked.connect(self.saveSession)
+        save_session_btn.setToolTip('Save the screens, image placement and a preview of the image to resume later')
+        files_layout.addWidget(save_session_btn)
+        open_session_btn = QPushButton('Open Session')
+        open_session_btn.clicked.connect(lambda: self.openSession())
+        open_session_btn.setToolTip('Resume a saved session')
+        files_layout.addWidget(open_session_btn)
+        main_layout.addLayout(files_layout)
+
+        if self.profile:
+            slicing.tracer.enabled = True
+            self.preview_widget.profiler = PaintProfiler()
+            save_trace_btn = QPushButton('Save Trace')
+            save_trace_btn.clicked.connect(self.saveTrace)
+            save_trace_btn.setToolTip('Save the recorded timings as a Chrome/Perfetto trace')
+            main_layout.addWidget(save_trace_btn)
 
         # Footer with centered 'Made by' button
         footer_layout = QHBoxLayout()
@@ -517,16 +1080,16 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(central_widget)
 
     def openWebsite(self):
+        import webbrowser
+
         webbrowser.open('https://clement.business')
 
     def configureScreens(self):
         dialog = ScreenConfigDialog()
         if dialog.exec_() == QDialog.Accepted:
             if dialog.getValues():
-                self.screen_resolutions = dialog.screen_resolutions
-                self.screen_diagonals = dialog.screen_diagonals
-                self.screen_aspect_ratios = dialog.screen_aspect_ratios
-                self.calculatePhysicalSizes()
+                self.screens = slicing.ScreenGeometry.from_config(
+                    dialog.screen_resolutions, dialog.screen_diagonals, dialog.screen_aspect_ratios)
                 self.arrangeScreens()
                 QMessageBox.information(self, 'Configuration Saved', 'Screen configuration has been saved.')
                 self.load_image_btn.setEnabled(True)
@@ -541,27 +1104,29 @@ class MainWindow(QMainWindow):
         if platform.system() != 'Windows':
             QMessageBox.warning(self, 'Unsupported OS', 'Inherit from Windows is only supported on Windows.')
             return
-        if get_monitors is None:
+        try:
+            from screeninfo import get_monitors
+        except ImportError:
             QMessageBox.warning(self, 'Module Missing', 'The screeninfo module is required for this feature.')
             return
         monitors = get_monitors()
-        self.screen_resolutions = []
-        self.screen_diagonals = []
-        self.screen_aspect_ratios = []
+        screen_resolutions = []
+        screen_diagonals = []
+        screen_aspect_ratios = []
         for m in monitors:
             width = m.width
             height = m.height
-            self.screen_resolutions.append((width, height))
+            screen_resolutions.append((width, height))
             if m.width_mm == 0 or m.height_mm == 0:
                 diag_cm = 54.6  # Assume a default size if dimensions are not available
             else:
                 diag_cm = math.hypot(m.width_mm, m.height_mm) / 10  # Convert mm to cm
-            self.screen_diagonals.append(diag_cm)
+            screen_diagonals.append(diag_cm)
             gcd = math.gcd(width, height)
             ratio_w = width // gcd
             ratio_h = height // gcd
-            self.screen_aspect_ratios.append((ratio_w, ratio_h))
-        self.calculatePhysicalSizes()
+            screen_aspect_ratios.append((ratio_w, ratio_h))
+        self.screens = slicing.ScreenGeometry.from_config(screen_resolutions, screen_diagonals, screen_aspect_ratios)
         self.arrangeScreens()
         QMessageBox.information(self, 'Configuration Saved', 'Screen configuration has been inherited from Windows.')
         self.load_image_btn.setEnabled(True)
@@ -570,10 +1135,8 @@ class MainWindow(QMainWindow):
 
     def editScreens(self):
         existing_screens = []
-        for i in range(len(self.screen_resolutions)):
-            res_width, res_height = self.screen_resolutions[i]
-            diag = self.screen_diagonals[i]
-            ratio_w, ratio_h = self.screen_aspect_ratios[i]
+        for screen in self.screens.screens.tolist():
+            res_width, res_height, diag, ratio_w, ratio_h = screen[4:9]
             existing_screens.append({
                 'res_width': res_width,
                 'res_height': res_height,
@@ -584,10 +1147,8 @@ class MainWindow(QMainWindow):
         dialog = ScreenConfigDialog(existing_screens)
         if dialog.exec_() == QDialog.Accepted:
             if dialog.getValues():
-                self.screen_resolutions = dialog.screen_resolutions
-                self.screen_diagonals = dialog.screen_diagonals
-                self.screen_aspect_ratios = dialog.screen_aspect_ratios
-                self.calculatePhysicalSizes()
+                self.screens = slicing.ScreenGeometry.from_config(
+                    dialog.screen_resolutions, dialog.screen_diagonals, dialog.screen_aspect_ratios)
                 self.arrangeScreens()
                 QMessageBox.information(self, 'Configuration Saved', 'Screen configuration has been updated.')
             else:
@@ -595,46 +1156,16 @@ class MainWindow(QMainWindow):
         else:
             pass  # User cancelled
 
-    def calculatePhysicalSizes(self):
-        self.screen_physical_sizes = []
-        for diag_cm, aspect_ratio in zip(self.screen_diagonals, self.screen_aspect_ratios):
-            ratio_w, ratio_h = aspect_ratio
-            aspect = ratio_w / ratio_h
-            h = diag_cm / math.sqrt(1 + aspect ** 2)
-            w = aspect * h
-            self.screen_physical_sizes.append((w, h))  # Physical width and height in cm
-
     def arrangeScreens(self):
         # Arrange screens in the preview area based on their physical sizes
-        self.screen_arrangement = []
-
-        # Calculate scaling factor to fit all screens into the preview area
-        total_width_cm = sum(w for w, h in self.screen_physical_sizes)
-        max_height_cm = max(h for w, h in self.screen_physical_sizes)
-
-        # Calculate scaling factor
         preview_width = self.preview_widget.width() - 50  # Some padding
         preview_height = self.preview_widget.height() - 50
-        scale_x = preview_width / total_width_cm
-        scale_y = preview_height / max_height_cm
-        scale = min(scale_x, scale_y)
-
-        # Arrange screens
-        x_offset = 25  # Initial padding
-        y_offset = 25  # Center vertically
-        for idx, (w_cm, h_cm) in enumerate(self.screen_physical_sizes):
-            screen_w = w_cm * scale
-            screen_h = h_cm * scale
-            pos = QPoint(int(x_offset), int(y_offset + (max_height_cm - h_cm) * scale / 2))
-            size = QSize(int(screen_w), int(screen_h))
-            self.screen_arrangement.append({'pos': pos, 'size': size})
-            x_offset += screen_w + 10  # 10 pixels spacing
-
-        self.preview_widget.screen_arrangement = self.screen_arrangement
-        self.preview_widget.screen_resolutions = self.screen_resolutions
-        self.preview_widget.screen_physical_sizes = self.screen_physical_sizes
+        self.screens.arrange(preview_width, preview_height)
+
+        self.preview_widget.screens = self.screens
         self.preview_widget.image_loaded = False  # Reset image loaded flag
         self.preview_widget.image_position = QPoint(0, 0)
+        self.preview_widget.invalidateScreenCache()
         self.preview_widget.update()
 
     def loadImage(self):
@@ -643,47 +1174,352 @@ class MainWindow(QMainWindow):
             return
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        image_file, _ = QFileDialog.getOpenFileName(self, 'Select Image File', '', 'Images (*.png *.jpg *.jpeg)', options=options)
+        image_file, _ = QFileDialog.getOpenFileName(self, 'Select Image File', '', 'Images (*.png *.jpg *.jpeg *.gif *.webp)', options=options)
         if image_file:
             self.image_path = image_file
             self.image_label.setText(image_file)
-            self.preview_widget.setImage(image_file)
+            self.preview_widget.setImage(image_file)  # Shows a quick preview first
         else:
             self.image_label.setText('No image selected.')
 
+    def imageLoadFailed(self, image_path, error):
+        if image_path == self.image_path:
+            self.image_path = ''
+            self.image_label.setText('No image selected.')
+        QMessageBox.warning(self, 'Image Error', f'Could not load {image_path}: {error}')
+
     def exportImages(self):
         if not self.image_path:
             QMessageBox.warning(self, 'No Image', 'Please load an image before exporting.')
             return
-        if not hasattr(self, 'screen_arrangement'):
+        if not os.path.exists(self.image_path):
+            QMessageBox.warning(self, 'Image Not Found', f'{self.image_path} was not found. Please load the image again.')
+            return
+        if self.screens is None:
             QMessageBox.warning(self, 'No Configuration', 'Please configure screens before exporting.')
             return
-        image = Image.open(self.image_path)
-        image_width, image_height = image.size
+        if self.export_pool is not None:
+            return  # An export is already running
+        image_size, frame_count, loop = slicing.animation_info(self.image_path)  # Reads the header only
+        placement = self.imagePlacement()
 
         # Use the image position and scale from the preview to calculate crop boxes on the original image
-        for idx, screen in enumerate(self.screen_arrangement):
-            # Calculate the crop box in the original image
-            left = (screen['pos'].x() - self.preview_widget.image_position.x()) / self.preview_widget.image_scale
-            upper = (screen['pos'].y() - self.preview_widget.image_position.y()) / self.preview_widget.image_scale
-            right = left + screen['size'].width() / self.preview_widget.image_scale
-            lower = upper + screen['size'].height() / self.preview_widget.image_scale
-
-            # Ensure the crop box is within the image bounds
-            left = max(0, int(left))
-            upper = max(0, int(upper))
-            right = min(image_width, int(right))
-            lower = min(image_height, int(lower))
-
-            if left >= right or upper >= lower:
+        # Each crop is rendered at the screen's native resolution
+        renders = self.screens.render_boxes(placement, image_size)
+        rendered = {idx for idx, box, size in renders}
+        for idx in range(len(self.screens)):
+            if idx not in rendered:
                 QMessageBox.warning(self, 'Export Error', f'Screen {idx+1} is outside the image boundaries.')
-                continue
+        encoder = None
+        if frame_count > 1:
+            # Animations become one numbered frame sequence per screen
+            jobs = [(box, size, f'screen_{idx+1}') for idx, box, size in renders]
+        else:
+            encoder = self.encoderSettings()
+            jobs = [(box, size, slicing.output_name(idx, encoder)) for idx, box, size in renders]
+        if not jobs:
+            return
+        # Screens rendered the same way from the same source are left alone
+        self.export_manifest = slicing.ExportManifest('.')
+        jobs = self.export_manifest.plan(slicing.source_hash(self.image_path), jobs, encoder)
+        if not jobs:
+            QMessageBox.information(self, 'Export Complete', 'All screens are up to date.')
+            return
 
-            box = (left, upper, right, lower)
-            cropped_image = image.crop(box)
-            # Save the cropped image at the original resolution
-            cropped_image.save(f'screen_{idx+1}.jpg')
-        QMessageBox.information(self, 'Export Complete', 'Images have been exported successfully.')
+        self.export_saved = []
+        self.export_cancel = threading.Event()
+        self.export_frame_dirs = []
+        workers = self.workers_spin.value()
+        total = len(jobs)
+        if frame_count > 1:
+            # Frames are streamed a few at a time; progress counts frames
+            def exportFrames():
+                durations = slicing.slice_frames(self.image_path, jobs, workers,
+                                                 on_frame=lambda: self.export_saved.append(None),
+                                                 cancel=self.export_cancel)
+                slicing.save_frame_timing('.', durations, loop)
+
+            self.export_pool = ThreadPoolExecutor(max_workers=1)
+            self.export_futures = [self.export_pool.submit(exportFrames)]
+            self.export_frame_dirs = [screen_dir for box, size, screen_dir in jobs]
+            total = frame_count
+        else:
+            # Screens that are MCU-aligned crops of a JPEG source are cut from
+            # its compressed data without decoding; the rest are rendered
+            crops, renders = slicing.lossless_crops(self.image_path, jobs, encoder)
+            self.export_pool = ThreadPoolExecutor(max_workers=workers)
+
+            def cropScreen(box, size, path):
+                self.export_saved.append(slicing.crop_jpeg(self.image_path, box, size, path, encoder))
+
+            self.export_futures = [self.export_pool.submit(cropScreen, box, size, path) for box, size, path in crops]
+            memory_budget = self.memory_spin.value() * 1024 * 1024
+            budgeted = renders and memory_budget and slicing.source_cache.peek(self.image_path) is None
+            if budgeted and slicing.can_stream(self.image_path):
+                # Stream the source in bands; screens are encoded as they complete
+                self.export_futures.append(self.export_pool.submit(
+                    slicing.stream_slice, self.image_path, renders, memory_budget,
+                    workers=workers, on_saved=self.export_saved.append, cancel=self.export_cancel, encoder=encoder))
+            elif budgeted:
+                # Only PNG and uncompressed sources can be read in bands; others
+                # are decoded whole, JPEG reduced as far as the screens allow
+                QMessageBox.warning(self, 'Memory Budget', 'This image format cannot be read in bands. It will be '
+                                                           'decoded whole and may use more memory than the budget.')
+                self.export_futures.append(self.export_pool.submit(
+                    slicing.draft_slice, self.image_path, renders, memory_budget,
+                    workers=workers, on_saved=self.export_saved.append, cancel=self.export_cancel, encoder=encoder))
+            elif renders:
+                # Reuse the preview's decoded source (decoding it if it was
+                # evicted), then crop and encode every screen on the worker pool
+                loaded = self.export_pool.submit(slicing.source_cache.get, self.image_path)
+
+                def renderScreen(box, size, path):
+                    self.export_saved.append(slicing.render_and_save(loaded.result().image, box, size, path, encoder))
+
+                self.export_futures += [self.export_pool.submit(renderScreen, box, size, path)
+                                        for box, size, path in renders]
+
+        self.startExportProgress(total)
+
+    def exportProfiles(self):
+        # The loaded image for several saved layouts (profiles), each at
+        # several output resolutions, into <layout name>/<resolution>/
+        # folders. The source is decoded once for all of them.
+        if not self.image_path or not os.path.exists(self.image_path):
+            QMessageBox.warning(self, 'No Image', 'Please load an image before exporting.')
+            return
+        if self.export_pool is not None:
+            return  # An export is already running
+        options = QFileDialog.Options()
+        layout_files, _ = QFileDialog.getOpenFileNames(self, 'Select Layout Profiles', '', 'JSON Files (*.json)',
+                                                       options=options)
+        if not layout_files:
+            return
+        resolutions, ok = QInputDialog.getText(self, 'Export Profiles', 'Output resolutions (comma separated):',
+                                               text='native, 1080p, 4k')
+        if not ok:
+            return
+        names = [os.path.splitext(os.path.basename(layout_file))[0] for layout_file in layout_files]
+        if len(set(names)) < len(names):
+            QMessageBox.warning(self, 'Export Error', 'Layout files need different names; they name the output folders.')
+            return
+        try:
+            profiles = list(zip(names, [slicing.load_layout(layout_file) for layout_file in layout_files]))
+            export = slicing.ProfileExport(self.image_path, profiles, resolutions.split(','), '.')
+        except (OSError, ValueError, KeyError) as e:
+            QMessageBox.warning(self, 'Export Error', f'Cannot export profiles: {e}')
+            return
+        if not export.jobs:
+            QMessageBox.information(self, 'Export Complete', 'All screens are up to date.')
+            return
+        # The export stands in for the manifest: finishExport records and saves
+        self.export_manifest = export
+        self.export_saved = []
+        self.export_cancel = threading.Event()
+        self.export_frame_dirs = []
+        self.export_pool = ThreadPoolExecutor(max_workers=1)
+        self.export_futures = [self.export_pool.submit(export.run, self.workers_spin.value(),
+                                                       on_saved=self.export_saved.append, cancel=self.export_cancel)]
+        self.startExportProgress(len(export.jobs))
+
+    def startExportProgress(self, total):
+        self.export_progress = QProgressDialog('Exporting screens...', 'Cancel', 0, total, self)
+        self.export_progress.setWindowTitle('Export')
+        self.export_progress.setWindowModality(Qt.WindowModal)
+        self.export_progress.setMinimumDuration(0)
+        self.export_progress.canceled.connect(self.cancelExport)
+        self.export_progress.setValue(0)
+        self.export_btn.setEnabled(False)
+        self.profiles_btn.setEnabled(False)
+        self.export_timer.start()
+
+    def pollExport(self):
+        self.export_progress.setValue(len(self.export_saved))
+        if not all(future.done() for future in self.export_futures):
+            return
+        errors = [future.exception() for future in self.export_futures
+                  if not future.cancelled() and future.exception() is not None]
+        if not errors:
+            self.export_saved.extend(self.export_frame_dirs)
+        self.finishExport()
+        if errors:
+            QMessageBox.warning(self, 'Export Error', f'Export failed: {errors[0]}')
+        else:
+            QMessageBox.information(self, 'Export Complete', 'Images have been exported successfully.')
+
+    def cancelExport(self):
+        if self.export_pool is None:
+            return
+        # Screens already being encoded finish; the rest are dropped
+        self.export_cancel.set()
+        for future in self.export_futures:
+            future.cancel()
+        self.finishExport()
+        QMessageBox.information(self, 'Export Cancelled', 'Export has been cancelled.')
+
+    def finishExport(self):
+        self.export_timer.stop()
+        # Record what was written; screens still encoding after a cancel are
+        # left out of the manifest and redone by the next export
+        for path in list(self.export_saved):
+            if path is not None:
+                self.export_manifest.done(path)
+        self.export_manifest.save()
+        self.export_pool.shutdown(wait=False)
+        self.export_pool = None
+        self.export_futures = []
+        self.export_progress.canceled.disconnect(self.cancelExport)
+        self.export_progress.close()
+        self.export_btn.setEnabled(True)
+        self.profiles_btn.setEnabled(True)
+
+    def encoderSettings(self):
+        image_format = self.format_combo.currentData()
+        options = {'target_bytes': self.target_spin.value() * 1024}
+        if image_format == 'jpeg':
+            options.update(quality=self.quality_spin.value(), progressive=self.progressive_check.isChecked(),
+                           subsampling=self.subsampling_combo.currentData())
+        elif image_format == 'webp':
+            options.update(quality=self.quality_spin.value(), lossless=self.lossless_check.isChecked())
+        if image_format == 'png' or options.get('lossless'):
+            options['target_bytes'] = None
+        return slicing.make_encoder(image_format, **options)
+
+    def setEncoderSettings(self, encoder):
+        self.format_combo.setCurrentIndex(max(0, self.format_combo.findData(encoder.get('format'))))
+        self.quality_spin.setValue(encoder.get('quality', self.quality_spin.value()))
+        self.progressive_check.setChecked(encoder.get('progressive', False))
+        subsampling_index = self.subsampling_combo.findData(encoder.get('subsampling'))
+        if subsampling_index >= 0:
+            self.subsampling_combo.setCurrentIndex(subsampling_index)
+        self.lossless_check.setChecked(encoder.get('lossless', False))
+        self.target_spin.setValue((encoder.get('target_bytes') or 0) // 1024)
+
+    def updateEncoderControls(self):
+        # Only the options of the selected format are editable
+        image_format = self.format_combo.currentData()
+        lossless = image_format == 'png' or (image_format == 'webp' and self.lossless_check.isChecked())
+        self.quality_spin.setEnabled(not lossless)
+        self.progressive_check.setEnabled(image_format == 'jpeg')
+        self.subsampling_combo.setEnabled(image_format == 'jpeg')
+        self.lossless_check.setEnabled(image_format == 'webp')
+        self.target_spin.setEnabled(not lossless)
+
+    def imagePlacement(self):
+        return {
+            'x': self.preview_widget.image_position.x(),
+            'y': self.preview_widget.image_position.y(),
+            'scale': self.preview_widget.image_scale
+        }
+
+    def saveLayout(self):
+        if self.screens is None:
+            QMessageBox.warning(self, 'No Configuration', 'Please configure screens before saving a layout.')
+            return
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        layout_file, _ = QFileDialog.getSaveFileName(self, 'Save Layout', 'layout.json', 'Layouts (*.json)', options=options)
+        if layout_file:
+            # Without a loaded image the headless slicer fits each image automatically
+            placement = self.imagePlacement() if self.preview_widget.image_loaded else None
+            slicing.save_layout(layout_file, self.screens.to_layout(), placement, self.encoderSettings())
+            QMessageBox.information(self, 'Layout Saved', f'Layout has been saved to {layout_file}.')
+
+    def saveSession(self):
+        if self.screens is None:
+            QMessageBox.warning(self, 'No Configuration', 'Please configure screens before saving a session.')
+            return
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        session_file, _ = QFileDialog.getSaveFileName(self, 'Save Session', 'session.slicer', 'Sessions (*.slicer)', options=options)
+        if not session_file:
+            return
+        session = {
+            'layout': {'screens': self.screens.to_layout()},
+            'settings': {
+                'workers': self.workers_spin.value(),
+                'memory_mb': self.memory_spin.value(),
+                'fit': self.fit_combo.currentData(),
+                'encoder': self.encoderSettings()
+            }
+        }
+        files = {}
+        if self.preview_widget.image_loaded:
+            # The preview's own proxy is embedded so reopening never decodes the source
+            session['layout']['placement'] = self.imagePlacement()
+            source_size = self.preview_widget.pyramid.source_size
+            session['source'] = slicing.source_reference(self.image_path, session_file)
+            session['source']['size'] = [source_size.width(), source_size.height()]
+            proxy = self.preview_widget.pyramid.levels[0]
+            if proxy.hasAlphaChannel():
+                session['proxy'] = 'proxy.png'
+                files['proxy.png'] = encodeImage(proxy, 'PNG')
+            else:
+                session['proxy'] = 'proxy.jpg'
+                files['proxy.jpg'] = encodeImage(proxy, 'JPG', 90)
+        slicing.save_session(session_file, session, files)
+        QMessageBox.information(self, 'Session Saved', f'Session has been saved to {session_file}.')
+
+    def openSession(self, session_file=None):
+        if not session_file:
+            options = QFileDialog.Options()
+            options |= QFileDialog.DontUseNativeDialog
+            session_file, _ = QFileDialog.getOpenFileName(self, 'Open Session', '', 'Sessions (*.slicer)', options=options)
+            if not session_file:
+                return
+        try:
+            session, files = slicing.load_session(session_file)
+        except Exception as e:
+            QMessageBox.warning(self, 'Session Error', f'Could not open {session_file}: {e}')
+            return
+
+        self.screens = slicing.ScreenGeometry.from_layout(session['layout']['screens'])
+        preview = self.preview_widget
+        preview.screens = self.screens
+        preview.screens_defined = True
+        preview.cancelLoad()
+        preview.image_loaded = False
+        preview.pyramid = None
+        preview.invalidateScreenCache()
+        self.load_image_btn.setEnabled(True)
+        self.edit_screens_btn.setEnabled(True)
+        settings = session.get('settings', {})
+        self.workers_spin.setValue(settings.get('workers', self.workers_spin.value()))
+        self.memory_spin.setValue(settings.get('memory_mb', self.memory_spin.value()))
+        fit_index = self.fit_combo.findData(settings.get('fit'))
+        if fit_index >= 0:
+            self.fit_combo.setCurrentIndex(fit_index)
+        if settings.get('encoder'):
+            self.setEncoderSettings(settings['encoder'])
+
+        self.image_path = ''
+        self.image_label.setText('No image selected.')
+        reference = session.get('source')
+        if reference:
+            image_path, unchanged = slicing.resolve_source(reference, session_file)
+            placement = session['layout'].get('placement')
+            if image_path is not None and not unchanged:
+                preview.setImage(image_path, placement)  # Edited since the session was saved
+            else:
+                preview.setProxy(QImage.fromData(files[session['proxy']]), QSize(*reference['size']))
+                if placement:
+                    preview.image_position = QPoint(placement['x'], placement['y'])
+                    preview.image_scale = placement['scale']
+            self.image_path = image_path or reference['path']
+            self.image_label.setText(self.image_path)
+            if image_path is None:
+                QMessageBox.warning(self, 'Image Not Found',
+                                    f"{reference['path']} was not found. The preview is shown, but exporting needs the image.")
+        preview.update()
+
+    def saveTrace(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        trace_file, _ = QFileDialog.getSaveFileName(self, 'Save Trace', 'screenslicer-trace.json', 'Traces (*.json)', options=options)
+        if trace_file:
+            count = slicing.tracer.save(trace_file)
+            QMessageBox.information(self, 'Trace Saved', f'{count} timing events have been saved to {trace_file}.\n'
+                                    'Open it in chrome://tracing or https://ui.perfetto.dev.')
 
     def zoomIn(self):
         self.preview_widget.zoomIn()
@@ -728,20 +1564,41 @@ class MainWindow(QMainWindow):
         # Calculate the ratio of grey area to the total image area
         if not self.preview_widget.image_loaded or not self.preview_widget.screens_defined:
             return 0
-        image_rect = QRect(self.preview_widget.image_position, self.preview_widget.image.size())
-        screens_rect = self.preview_widget.calculateScreensBoundingRect()
-        intersection = image_rect.intersected(screens_rect)
+        image_rect = self.preview_widget.imageRect()
         image_area = image_rect.width() * image_rect.height()
-        intersection_area = intersection.width() * intersection.height()
+        # Only the part of the image that lands on a screen counts, not the gaps
+        intersection_area = float(self.screens.union_overlap(
+            [(image_rect.x(), image_rect.y(), image_rect.width(), image_rect.height())])[0])
         grey_area = image_area - intersection_area
         grey_area_ratio = grey_area / image_area if image_area > 0 else 0
         return grey_area_ratio
 
     def tryToFit(self):
-        self.preview_widget.fitImageToScreens()
+        self.preview_widget.fitImageToScreens(self.fit_combo.currentData())
+
+def printStartupProfile():
+    markStartup('first event loop iteration')
+    start = startup_marks[0][1]
+    print('Startup profile (ms):', file=sys.stderr)
+    for (_, previous), (label, stamp) in zip(startup_marks, startup_marks[1:]):
+        print(f'  {label:<32} {(stamp - previous) * 1000:8.1f}', file=sys.stderr)
+    print(f"  {'total':<32} {(startup_marks[-1][1] - start) * 1000:8.1f}", file=sys.stderr)
+    deferred = [name for name in ('PIL', 'numpy', 'screeninfo') if name in sys.modules]
+    print(f"Deferred modules loaded during startup: {', '.join(deferred) or 'none'}", file=sys.stderr)
+    QApplication.instance().quit()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    mainWin = MainWindow()
+    markStartup('create QApplication')
+    mainWin = MainWindow(profile='--profile' in sys.argv)
+    markStartup('build MainWindow')
     mainWin.show()
+    markStartup('show MainWindow')
+    sessions = [arg for arg in sys.argv[1:] if arg.endswith('.slicer')]
+    if sessions:
+        mainWin.openSession(sessions[0])
+        markStartup('open session')
+    if '--profile-startup' in sys.argv:
+        # Runs once the window has been laid out and painted, then exits
+        QTimer.singleShot(0, printStartupProfile)
     sys.exit(app.exec_())
@@ -0,0 +1,333 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks for the preview and export hot paths. Runs under Qt's offscreen
+# platform, so it works on a headless Linux box:
+#
+#   python benchmark.py run --output before.json
+#   python benchmark.py run --output after.json
+#   python benchmark.py compare before.json after.json
+#
+# Every source size runs in its own process so its peak RSS is measured on
+# its own. Timings are in milliseconds.
+
+DEFAULT_SIZES = '2,24,200'  # Source megapixels
+DEFAULT_SCREENS = '1,9,100'  # Screens in the benchmark layouts
+DRAG_STEPS = 60
+# A benchmark regresses when it is this much slower (or bigger) and by more
+# than the noise floor below
+DEFAULT_THRESHOLD = 0.10
+MIN_DELTA_MS = 1.0
+MIN_DELTA_MB = 5.0
+
+
+def parse_list(text, kind=float):
+    return [kind(item) for item in text.split(',') if item]
+
+
+def source_path(workdir, megapixels):
+    # A synthetic 3:2 JPEG with gradients and noise, generated once per size
+    from PIL import Image
+
+    width = int((megapixels * 1e6 * 3 / 2) ** 0.5)
+    height = int(width * 2 / 3)
+    path = os.path.join(workdir, f'source_{megapixels:g}mp.jpg')
+    if not os.path.exists(path):
+        red = Image.linear_gradient('L').resize((width, height))
+        green = Image.linear_gradient('L').transpose(Image.ROTATE_90).resize((width, height))
+        blue = Image.effect_noise((width, height), 48)
+        Image.merge('RGB', (red, green, blue)).save(path, quality=90)
+    return path
+
+
+def grid_layout(count):
+    # count 1920x1080 screens in a near-square grid, in preview pixels
+    import slicing
+
+    columns = max(1, round(count ** 0.5))
+    rows = -(-count // columns)
+    width = (1100 - 10 * (columns - 1)) // columns
+    height = width * 9 // 16
+    if rows * (height + 10) > 800:
+        height = (800 - 10 * (rows - 1)) // rows
+        width = height * 16 // 9
+    screens = [{'x': 25 + (idx % columns) * (width + 10), 'y': 25 + (idx // columns) * (height + 10),
+                'width': width, 'height': height, 'resolution': [1920, 1080]} for idx in range(count)]
+    return slicing.ScreenGeometry.from_layout(screens)
+
+
+def summarize(name, megapixels, screens, samples):
+    samples = sorted(samples)
+    return {
+        'benchmark': name,
+        'source_mp': megapixels,
+        'screens': screens,
+        'median_ms': round(statistics.median(samples), 3),
+        'min_ms': round(samples[0], 3),
+        'max_ms': round(samples[-1], 3),
+        'runs': len(samples)
+    }
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(megapixels, screen_counts, repeat, workdir):
+    # All benchmarks for one source size, in this process
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    path = source_path(workdir, megapixels)
+    import ScreenSlicer
+    import slicing
+    from PyQt5.QtCore import QEvent, QPoint, QPointF, Qt
+    from PyQt5.QtGui import QMouseEvent
+    from PyQt5.QtWidgets import QApplication, QMessageBox
+
+    # Export and fit report through message boxes; nobody is there to close them
+    QMessageBox.information = staticmethod(lambda *args, **kwargs: None)
+    QMessageBox.warning = staticmethod(lambda *args, **kwargs: None)
+    app = QApplication.instance() or QApplication([sys.argv[0]])
+    window = ScreenSlicer.MainWindow()
+    window.resize(1200, 900)
+    window.show()
+    app.processEvents()
+    preview = window.preview_widget
+
+    # Time every paintEvent the widget receives
+    paint_times = []
+    paint_event = preview.paintEvent
+
+    def timedPaintEvent(event):
+        start = time.perf_counter()
+        paint_event(event)
+        paint_times.append((time.perf_counter() - start) * 1000)
+
+    preview.paintEvent = timedPaintEvent
+
+    def mouseEvent(kind, pos):
+        button = Qt.NoButton if kind == QEvent.MouseMove else Qt.LeftButton
+        return QMouseEvent(kind, QPointF(pos), button, Qt.LeftButton, Qt.NoModifier)
+
+    results = []
+    geometry = grid_layout(screen_counts[0])
+    window.screens = geometry
+    preview.screens = geometry
+    preview.screens_defined = True
+    window.image_path = path
+
+    # Loading runs in the background: time the first preview and the full load
+    samples, first_samples = [], []
+    for _ in range(repeat):
+        slicing.source_cache.clear()
+        start = time.perf_counter()
+        preview.setImage(path)
+        generation = preview.load_generation
+        first = None
+        while preview.isLoading():
+            app.processEvents()
+            if first is None and preview.shown_generation == generation:
+                first = (time.perf_counter() - start) * 1000
+            time.sleep(0.001)
+        app.processEvents()
+        samples.append((time.perf_counter() - start) * 1000)
+        first_samples.append(first if first is not None else samples[-1])
+    results.append(summarize('first_preview', megapixels, None, first_samples))
+    results.append(summarize('set_image', megapixels, None, samples))
+
+    os.chdir(workdir)
+    for count in screen_counts:
+        geometry = grid_layout(count)
+        window.screens = geometry
+        preview.screens = geometry
+        preview.invalidateScreenCache()
+
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            preview.fitImageToScreens()
+            samples.append((time.perf_counter() - start) * 1000)
+            if not preview.cachedCoverage().all():
+                raise RuntimeError(f'"Try to Fit" left screens uncovered ({megapixels:g} MP, {count} screens)')
+        results.append(summarize('fit_image', megapixels, count, samples))
+        preview.repaint()
+        app.processEvents()
+
+        samples = []
+        for step in range(repeat * 2):
+            start = time.perf_counter()
+            preview.scaleImage(1.05 if step % 2 == 0 else 1 / 1.05)
+            preview.repaint()
+            samples.append((time.perf_counter() - start) * 1000)
+        results.append(summarize('scale_image', megapixels, count, samples))
+
+        # Drag the image around, one frame per move
+        preview.repaint()
+        app.processEvents()
+        image_rect = preview.widgetRect(preview.imageRect())
+        start_pos = image_rect.center()
+        preview.mousePressEvent(mouseEvent(QEvent.MouseButtonPress, start_pos))
+        del paint_times[:]
+        frame_times = []
+        for step in range(DRAG_STEPS):
+            offset = QPoint(step % 20 - 10, (step * 3) % 14 - 7)
+            start = time.perf_counter()
+            preview.mouseMoveEvent(mouseEvent(QEvent.MouseMove, start_pos + offset))
+            preview.frame_timer.stop()
+            preview.flushRepaint()
+            app.processEvents()
+            frame_times.append((time.perf_counter() - start) * 1000)
+        preview.mouseReleaseEvent(mouseEvent(QEvent.MouseButtonRelease, start_pos))
+        results.append(summarize('drag_frame', megapixels, count, frame_times))
+        if paint_times:
+            results.append(summarize('drag_paint_event', megapixels, count, paint_times))
+
+        samples = []
+        for _ in range(repeat):
+            if os.path.exists(slicing.MANIFEST_NAME):
+                os.remove(slicing.MANIFEST_NAME)  # Otherwise nothing is exported again
+            start = time.perf_counter()
+            window.exportImages()
+            while window.export_pool is not None:
+                app.processEvents()
+                time.sleep(0.005)
+            samples.append((time.perf_counter() - start) * 1000)
+        results.append(summarize('export_images', megapixels, count, samples))
+    for name in os.listdir(workdir):
+        if name.startswith('screen_') or name == slicing.MANIFEST_NAME:
+            os.remove(os.path.join(workdir, name))
+
+    results.append({'benchmark': 'peak_rss', 'source_mp': megapixels, 'screens': None,
+                    'peak_rss_mb': peak_rss_mb()})
+    return results
+
+
+def environment():
+    from PIL import __version__ as pillow_version
+    from PyQt5.QtCore import QT_VERSION_STR
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'qt': QT_VERSION_STR,
+        'pillow': pillow_version
+    }
+
+
+def run(args):
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), 'screenslicer-bench')
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for megapixels in parse_list(args.sizes):
+        print(f'{megapixels:g} MP...', file=sys.stderr)
+        case = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', '--size', f'{megapixels:g}',
+                               '--screens', args.screens, '--repeat', str(args.repeat), '--workdir', workdir],
+                              capture_output=True, text=True)
+        if case.returncode != 0:
+            print(case.stderr, file=sys.stderr)
+            return 1
+        results.extend(json.loads(case.stdout))
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print_results(results)
+    return 0
+
+
+def print_results(results):
+    for result in results:
+        screens = '' if result['screens'] is None else f"{result['screens']} screens"
+        if 'peak_rss_mb' in result:
+            value = f"{result['peak_rss_mb']} MB"
+        else:
+            value = f"{result['median_ms']:.1f} ms (min {result['min_ms']:.1f}, max {result['max_ms']:.1f})"
+        print(f"{result['benchmark']:<18} {result['source_mp']:>6g} MP {screens:>12}  {value}")
+
+
+def compare(args):
+    # Flag every benchmark of the new run slower (or bigger) than the base run
+    def load(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return {(result['benchmark'], result['source_mp'], result['screens']): result
+                    for result in json.load(f)['results']}
+
+    base, new = load(args.base), load(args.new)
+    regressions = 0
+    for key, result in new.items():
+        if key not in base:
+            continue
+        metric, min_delta, unit = ('peak_rss_mb', MIN_DELTA_MB, 'MB') if 'peak_rss_mb' in result \
+            else ('median_ms', MIN_DELTA_MS, 'ms')
+        before, after = base[key].get(metric), result.get(metric)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        regressed = after > before * (1 + args.threshold) and after - before > min_delta
+        regressions += regressed
+        name, megapixels, screens = key
+        screens = '' if screens is None else f'{screens} screens'
+        flag = 'REGRESSION' if regressed else ''
+        print(f'{name:<18} {megapixels:>6g} MP {screens:>12}  {before:10.1f} -> {after:10.1f} {unit} '
+              f'{change:+7.1%}  {flag}')
+    print(f'{regressions} regression(s) above {args.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'source megapixels (default: {DEFAULT_SIZES})')
+    run_parser.add_argument('--screens', default=DEFAULT_SCREENS,
+                            help=f'screens per layout (default: {DEFAULT_SCREENS})')
+    run_parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark (default: 3)')
+    run_parser.add_argument('--workdir', default=None, help='where sources and exports are written')
+    run_parser.add_argument('--output', default=None, help='write the results to this JSON file')
+
+    case_parser = commands.add_parser('case', help=argparse.SUPPRESS)
+    case_parser.add_argument('--size', type=float, required=True)
+    case_parser.add_argument('--screens', required=True)
+    case_parser.add_argument('--repeat', type=int, required=True)
+    case_parser.add_argument('--workdir', required=True)
+
+    compare_parser = commands.add_parser('compare', help='flag regressions between two runs')
+    compare_parser.add_argument('base', help='results of the reference run')
+    compare_parser.add_argument('new', help='results of the run to check')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help=f'relative slowdown that counts as a regression (default: {DEFAULT_THRESHOLD})')
+
+    args = parser.parse_args(argv)
+    if args.command == 'case':
+        results = run_case(args.size, parse_list(args.screens, int), args.repeat, args.workdir)
+        json.dump(results, sys.stdout)
+        return 0
+    if args.command == 'compare':
+        return compare(args)
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
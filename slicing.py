@@ -0,0 +1,2540 @@
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Headless slicing engine shared by the GUI export and the command line.
+# This module must not import PyQt5: it runs in worker processes and on
+# machines without a display.
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+# Module name -> pip package, checked by the diagnose command
+REQUIRED_MODULES = {
+    'PyQt5': 'PyQt5',
+    'PIL': 'Pillow',
+    'numpy': 'numpy',
+    'screeninfo': 'screeninfo'  # For getting display info from Windows
+}
+
+# Bits per pixel of the raw layouts the band reader can seek into directly
+RAW_BITS = {
+    '1': 1, 'L': 8, 'P': 8, 'LA': 16, 'I;16': 16, 'I;16B': 16,
+    'RGB': 24, 'BGR': 24, 'RGBA': 32, 'BGRA': 32, 'RGBX': 32, 'BGRX': 32, 'CMYK': 32
+}
+# 8-bit PNG layouts whose scanlines can be re-fed to Pillow band by band
+PNG_STREAM_MODES = ('L', 'LA', 'P', 'RGB', 'RGBA')
+# Lanczos reaches this many source pixels (per unit of downscale) each side
+LANCZOS_SUPPORT = 3
+# Integer reduce() before the final resample once the ratio exceeds this
+REDUCING_GAP = 3.0
+# Decoded frames of an animation allowed in flight at once
+FRAME_WINDOW = 3
+# Per output directory record of what every output was rendered from
+MANIFEST_NAME = 'screenslicer-manifest.json'
+# Images the watch command has finished, kept in its output directory
+JOURNAL_NAME = 'screenslicer-journal.jsonl'
+# Format version written into session files
+SESSION_VERSION = 1
+# Most recent timing spans kept by the tracer
+TRACE_MAX_EVENTS = 200000
+# Placement objectives understood by solve_placement
+FIT_OBJECTIVES = ('cover', 'contain', 'balanced', 'center', 'detail')
+# Scales tried between the contain and cover fits by the balanced objective
+FIT_SCALE_STEPS = 33
+# Float error tolerated when a placed image is measured in whole pixels
+PIXEL_EPSILON = 1e-6
+# The detail objective: long side of the image proxy it analyses, the zoom
+# beyond the cover fit it may use, and the scales and offsets it tries
+DETAIL_PROXY_SIDE = 384
+DETAIL_MAX_ZOOM = 1.25
+DETAIL_SCALE_STEPS = 9
+DETAIL_OFFSET_STEPS = 49
+# Detail is blurred into regions this fraction of the proxy's long side wide
+DETAIL_BLUR = 0.02
+# Output formats: file extension, Pillow format and default encoder options
+ENCODERS = {
+    'jpeg': ('.jpg', 'JPEG', {'quality': 75, 'progressive': False, 'optimize': False, 'subsampling': '4:2:0',
+                              'background': '#000000'}),
+    'png': ('.png', 'PNG', {'compress_level': 6}),
+    'webp': ('.webp', 'WEBP', {'quality': 80, 'lossless': False, 'method': 4})
+}
+JPEG_SUBSAMPLING = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
+# Accepted values of the numeric encoder options
+ENCODER_RANGES = {'quality': (1, 100), 'method': (0, 6), 'compress_level': (0, 9)}
+# Qualities searched for a target size, and trial encodes run at once
+TARGET_QUALITY_RANGE = (5, 95)
+TRIAL_ENCODES = 4
+# Crop boxes within this many source pixels of whole pixels count as exact
+# for lossless JPEG crops
+CROP_TOLERANCE = 1e-3
+# Opt-in on-disk decode cache: directory and size cap, read from the
+# environment so worker processes share the setting
+DECODE_CACHE_ENV = 'SCREENSLICER_DECODE_CACHE'
+DECODE_CACHE_SIZE_ENV = 'SCREENSLICER_DECODE_CACHE_MB'
+DECODE_CACHE_SIZE_MB = 10240
+# Proxy levels stored with a cached source, from this long side down
+CACHE_PROXY_MAX_SIDE = 4096
+CACHE_PROXY_MIN_SIDE = 256
+# Named output resolutions for profile exports: the short side of every
+# screen's output, in pixels
+RESOLUTIONS = {'720p': 720, '1080p': 1080, '1440p': 1440, '2160p': 2160, '4k': 2160, '8k': 4320}
+# Default address of the slicing service (only this machine can reach it)
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+# Memory the service's workers may keep decoded sources in, in total (MB)
+SERVICE_CACHE_MB = 2048
+
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.category, self.start, time.perf_counter_ns(), self.args)
+
+
+class Tracer:
+    # Timing spans in the Chrome trace event format, for chrome://tracing or
+    # ui.perfetto.dev. Does nothing until enabled. Timestamps come from the
+    # monotonic clock shared by all processes, so spans recorded in worker
+    # processes line up with the parent's. Safe to use from any thread.
+
+    def __init__(self):
+        self.enabled = False
+        self.events = deque(maxlen=TRACE_MAX_EVENTS)
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def span(self, name, category='slicing', **args):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return Span(self, name, category, args)
+
+    def record(self, name, category, start_ns, end_ns, args):
+        thread = threading.current_thread()
+        event = {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': start_ns / 1000, 'dur': (end_ns - start_ns) / 1000,
+            'pid': os.getpid(), 'tid': thread.ident, 'args': args
+        }
+        with self.lock:
+            self.events.append(event)
+            self.threads[(os.getpid(), thread.ident)] = thread.name
+
+    def take(self):
+        # Remove and return the recorded events, with thread names
+        with self.lock:
+            events = list(self.events)
+            events.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                          for (pid, tid), name in self.threads.items())
+            self.events.clear()
+            self.threads.clear()
+        return events
+
+    def extend(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def save(self, trace_path):
+        events = self.take()
+
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        replace_atomically(trace_path, write)
+        return len(events)
+
+
+# Shared by the GUI, export workers and the command line
+tracer = Tracer()
+
+
+def check_layout(layout, layout_path=None):
+    # Raise ValueError for a layout that cannot be sliced
+    if not isinstance(layout, dict) or not layout.get('screens'):
+        raise ValueError(f'{layout_path}: layout has no screens' if layout_path else 'layout has no screens')
+    return layout
+
+
+def load_layout(layout_path):
+    with open(layout_path, 'r', encoding='utf-8') as f:
+        return check_layout(json.load(f), layout_path)
+
+
+def save_layout(layout_path, screens, placement=None, encoder=None):
+    # screens: list of dicts with x, y, width, height (preview pixels) and
+    # resolution; placement: dict with x, y and scale, or None to auto-fit;
+    # encoder: output settings from make_encoder, or None for the defaults
+    layout = {'screens': screens}
+    if placement is not None:
+        layout['placement'] = placement
+    if encoder is not None:
+        layout['encoder'] = encoder
+    with open(layout_path, 'w', encoding='utf-8') as f:
+        json.dump(layout, f, indent=2)
+
+
+SCREEN_FIELDS = [
+    ('x', 'i4'), ('y', 'i4'), ('width', 'i4'), ('height', 'i4'),  # Preview pixels
+    ('res_w', 'i4'), ('res_h', 'i4'),  # Native resolution, 0 when unknown
+    ('diag', 'f8'), ('ratio_w', 'i4'), ('ratio_h', 'i4'),
+    ('phys_w', 'f8'), ('phys_h', 'f8')  # Physical size in cm
+]
+
+
+def save_session(session_path, session, files):
+    # A session is a zip holding session.json and the embedded images, given
+    # as {name: encoded bytes}. The images are already compressed, so they
+    # are stored as they are.
+    import zipfile
+
+    session = dict(session, version=SESSION_VERSION)
+
+    def write(tmp_path):
+        with zipfile.ZipFile(tmp_path, 'w') as archive:
+            archive.writestr('session.json', json.dumps(session, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+            for name, data in files.items():
+                archive.writestr(name, data)
+
+    replace_atomically(session_path, write)
+
+
+def load_session(session_path):
+    import zipfile
+
+    with zipfile.ZipFile(session_path) as archive:
+        session = json.loads(archive.read('session.json'))
+        if session.get('version', 0) > SESSION_VERSION:
+            raise ValueError(f'{session_path} was saved by a newer version of ScreenSlicer')
+        files = {name: archive.read(name) for name in archive.namelist() if name != 'session.json'}
+    return session, files
+
+
+def source_reference(image_path, session_path):
+    # How a session finds its source again: absolute path, path relative to
+    # the session (for folders moved as a whole) and a cheap signature
+    stat = os.stat(image_path)
+    image_path = os.path.abspath(image_path)
+    try:
+        relative_path = os.path.relpath(image_path, os.path.dirname(os.path.abspath(session_path)))
+    except ValueError:  # Another drive on Windows
+        relative_path = os.path.basename(image_path)
+    return {
+        'path': image_path,
+        'relative_path': relative_path,
+        'signature': [stat.st_mtime_ns, stat.st_size]
+    }
+
+
+def resolve_source(reference, session_path):
+    # (path, unchanged): the source where it was saved, else next to the
+    # session as it was then; path is None when neither exists
+    candidates = [reference['path'],
+                  os.path.join(os.path.dirname(os.path.abspath(session_path)), reference['relative_path'])]
+    for path in candidates:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return path, [stat.st_mtime_ns, stat.st_size] == reference['signature']
+    return None, False
+
+
+class ScreenGeometry:
+    # All screens of a wall in one NumPy structured array, so coverage,
+    # bounds and crop boxes are computed for every screen at once. A uniform
+    # grid over the preview plane answers hit tests and region queries
+    # without scanning all screens.
+
+    def __init__(self, screens):
+        self.screens = screens
+        self.grid = None
+        self.cell = 1
+        self.union = None
+
+    @classmethod
+    def empty(cls, count):
+        import numpy as np
+
+        return cls(np.zeros(count, dtype=SCREEN_FIELDS))
+
+    @classmethod
+    def from_config(cls, resolutions, diagonals, aspect_ratios):
+        import numpy as np
+
+        geometry = cls.empty(len(resolutions))
+        screens = geometry.screens
+        screens['res_w'], screens['res_h'] = np.array(resolutions, dtype='i4').reshape(-1, 2).T
+        screens['diag'] = diagonals
+        screens['ratio_w'], screens['ratio_h'] = np.array(aspect_ratios, dtype='i4').reshape(-1, 2).T
+        aspect = screens['ratio_w'] / screens['ratio_h']
+        screens['phys_h'] = screens['diag'] / np.sqrt(1 + aspect ** 2)
+        screens['phys_w'] = aspect * screens['phys_h']
+        return geometry
+
+    @classmethod
+    def from_layout(cls, layout_screens):
+        import numpy as np
+
+        geometry = cls.empty(len(layout_screens))
+        screens = geometry.screens
+        for field in ('x', 'y', 'width', 'height'):
+            screens[field] = [screen[field] for screen in layout_screens]
+        resolutions = [screen.get('resolution') or (0, 0) for screen in layout_screens]
+        screens['res_w'] = [resolution[0] for resolution in resolutions]
+        screens['res_h'] = [resolution[1] for resolution in resolutions]
+        # Physical sizes, when the layout kept them (sessions do)
+        screens['diag'] = [screen.get('diagonal', 0) for screen in layout_screens]
+        ratios = [screen.get('aspect_ratio') or (0, 0) for screen in layout_screens]
+        screens['ratio_w'] = [ratio[0] for ratio in ratios]
+        screens['ratio_h'] = [ratio[1] for ratio in ratios]
+        known = screens['ratio_h'] > 0
+        aspect = np.where(known, screens['ratio_w'] / np.maximum(screens['ratio_h'], 1), 0)
+        screens['phys_h'] = np.where(known, screens['diag'] / np.sqrt(1 + aspect ** 2), 0)
+        screens['phys_w'] = aspect * screens['phys_h']
+        return geometry
+
+    def to_layout(self):
+        layout_screens = []
+        for screen in self.screens.tolist():
+            x, y, width, height, res_w, res_h, diag, ratio_w, ratio_h = screen[:9]
+            layout_screen = {'x': x, 'y': y, 'width': width, 'height': height}
+            if res_w and res_h:
+                layout_screen['resolution'] = [res_w, res_h]
+            if diag and ratio_w and ratio_h:
+                layout_screen['diagonal'] = diag
+                layout_screen['aspect_ratio'] = [ratio_w, ratio_h]
+            layout_screens.append(layout_screen)
+        return layout_screens
+
+    def __len__(self):
+        return len(self.screens)
+
+    def rect(self, idx):
+        screen = self.screens[idx]
+        return int(screen['x']), int(screen['y']), int(screen['width']), int(screen['height'])
+
+    def rects(self):
+        return self.screens[['x', 'y', 'width', 'height']].tolist()
+
+    def arrange(self, preview_width, preview_height, padding=25, spacing=10):
+        # Side by side in the preview, scaled from the physical sizes,
+        # vertically centered, spacing pixels apart
+        import numpy as np
+
+        screens = self.screens
+        max_height_cm = screens['phys_h'].max()
+        scale = min(preview_width / screens['phys_w'].sum(), preview_height / max_height_cm)
+        screen_w = screens['phys_w'] * scale
+        screen_h = screens['phys_h'] * scale
+        x_offset = padding + np.concatenate(([0.0], np.cumsum(screen_w + spacing)[:-1]))
+        screens['x'] = x_offset.astype('i4')
+        screens['y'] = (padding + (max_height_cm - screens['phys_h']) * scale / 2).astype('i4')
+        screens['width'] = screen_w.astype('i4')
+        screens['height'] = screen_h.astype('i4')
+        self.grid = None
+        self.union = None
+
+    def move(self, idx, x, y):
+        self.union = None
+        self.remove_from_grid(idx)
+        self.screens[idx]['x'] = x
+        self.screens[idx]['y'] = y
+        self.add_to_grid(idx)
+
+    def bounds(self):
+        # Bounding rect of all screens as (left, top, width, height)
+        screens = self.screens
+        left, top = int(screens['x'].min()), int(screens['y'].min())
+        right = int((screens['x'] + screens['width']).max())
+        bottom = int((screens['y'] + screens['height']).max())
+        return left, top, right - left, bottom - top
+
+    def coverage(self, rect):
+        # Whether rect (x, y, width, height) fully contains each screen
+        x, y, width, height = rect
+        screens = self.screens
+        return ((screens['x'] >= x) & (screens['y'] >= y)
+                & (screens['x'] + screens['width'] <= x + width)
+                & (screens['y'] + screens['height'] <= y + height))
+
+    def render_boxes(self, placement, image_size):
+        # Crop box of every screen in source pixels (floats, clamped to the
+        # image) and the output size: the screen's native resolution, reduced
+        # in proportion when the image covers only part of the screen.
+        # Returns (index, box, size) for the screens that overlap the image.
+        import numpy as np
+
+        screens = self.screens
+        image_width, image_height = image_size
+        scale = placement['scale']
+        left = (screens['x'] - placement['x']) / scale
+        upper = (screens['y'] - placement['y']) / scale
+        right = left + screens['width'] / scale
+        lower = upper + screens['height'] / scale
+
+        boxes = np.stack([np.maximum(left, 0.0), np.maximum(upper, 0.0),
+                          np.minimum(right, float(image_width)), np.minimum(lower, float(image_height))], axis=1)
+        box_w = boxes[:, 2] - boxes[:, 0]
+        box_h = boxes[:, 3] - boxes[:, 1]
+        valid = (box_w > 0) & (box_h > 0)
+
+        known = (screens['res_w'] > 0) & (screens['res_h'] > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sizes_w = np.where(known, screens['res_w'] * box_w / (right - left), box_w)
+            sizes_h = np.where(known, screens['res_h'] * box_h / (lower - upper), box_h)
+        sizes = np.maximum(1, np.round(np.stack([sizes_w, sizes_h], axis=1))).astype(int)
+        return [(int(idx), tuple(boxes[idx].tolist()), tuple(sizes[idx].tolist())) for idx in np.nonzero(valid)[0]]
+
+    # Exact screen union, on a grid compressed to the screens' edges
+
+    def union_cells(self):
+        # Column edges, row edges and which cells lie on a screen; screens
+        # that overlap are counted once and the gaps between them not at all
+        import numpy as np
+
+        if self.union is None:
+            screens = self.screens
+            xs = np.unique(np.concatenate((screens['x'], screens['x'] + screens['width']))).astype(float)
+            ys = np.unique(np.concatenate((screens['y'], screens['y'] + screens['height']))).astype(float)
+            mask = np.zeros((max(len(ys) - 1, 0), max(len(xs) - 1, 0)))
+            for x, y, width, height in self.rects():
+                columns = np.searchsorted(xs, (x, x + width))
+                rows = np.searchsorted(ys, (y, y + height))
+                mask[rows[0]:rows[1], columns[0]:columns[1]] = 1
+            self.union = xs, ys, mask
+        return self.union
+
+    def union_overlap(self, rects):
+        # Area of each (x, y, width, height) rect that lands on a screen
+        import numpy as np
+
+        xs, ys, mask = self.union_cells()
+        rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+        left, top = rects[:, 0:1], rects[:, 1:2]
+        right, bottom = left + rects[:, 2:3], top + rects[:, 3:4]
+        over_x = np.clip(np.minimum(right, xs[1:]) - np.maximum(left, xs[:-1]), 0, None)
+        over_y = np.clip(np.minimum(bottom, ys[1:]) - np.maximum(top, ys[:-1]), 0, None)
+        return np.einsum('kr,rc,kc->k', over_y, mask, over_x)
+
+    def union_centroid(self):
+        # Center of the screen area, weighting every screen by its size
+        import numpy as np
+
+        xs, ys, mask = self.union_cells()
+        cell_w, cell_h = np.diff(xs), np.diff(ys)
+        areas = mask * np.outer(cell_h, cell_w)
+        total = areas.sum()
+        center_x = (areas.sum(axis=0) * (xs[:-1] + cell_w / 2)).sum() / total
+        center_y = (areas.sum(axis=1) * (ys[:-1] + cell_h / 2)).sum() / total
+        return center_x, center_y
+
+    # Spatial index: screen indices bucketed by the grid cells they overlap
+
+    def cell_range(self, x, y, width, height):
+        cell = self.cell
+        return (range(x // cell, (x + max(width, 1) - 1) // cell + 1),
+                range(y // cell, (y + max(height, 1) - 1) // cell + 1))
+
+    def build_grid(self):
+        import numpy as np
+
+        screens = self.screens
+        self.cell = max(1, int(np.median(np.maximum(screens['width'], screens['height'])))) if len(screens) else 1
+        self.grid = {}
+        for idx in range(len(screens)):
+            self.add_to_grid(idx)
+
+    def add_to_grid(self, idx):
+        if self.grid is None:
+            return
+        columns, rows = self.cell_range(*self.rect(idx))
+        for column in columns:
+            for row in rows:
+                self.grid.setdefault((column, row), set()).add(idx)
+
+    def remove_from_grid(self, idx):
+        if self.grid is None:
+            return
+        columns, rows = self.cell_range(*self.rect(idx))
+        for column in columns:
+            for row in rows:
+                self.grid.get((column, row), set()).discard(idx)
+
+    def query(self, x, y, width, height):
+        # Indices of the screens intersecting the rect, in drawing order
+        if not len(self.screens):
+            return []
+        if self.grid is None:
+            self.build_grid()
+        # Only the cells inside the wall's bounds can hold screens
+        left, top, bounds_w, bounds_h = self.bounds()
+        x0, y0 = max(x, left), max(y, top)
+        x1, y1 = min(x + width, left + bounds_w), min(y + height, top + bounds_h)
+        if x1 <= x0 or y1 <= y0:
+            return []
+        columns, rows = self.cell_range(x0, y0, x1 - x0, y1 - y0)
+        candidates = set()
+        for column in columns:
+            for row in rows:
+                candidates |= self.grid.get((column, row), set())
+        hits = []
+        for idx in sorted(candidates):
+            sx, sy, sw, sh = self.rect(idx)
+            if sx < x + width and x < sx + sw and sy < y + height and y < sy + sh:
+                hits.append(idx)
+        return hits
+
+    def hit_test(self, x, y):
+        # Topmost (last drawn) screen containing the point, or None
+        hits = self.query(x, y, 1, 1)
+        return hits[-1] if hits else None
+
+
+def placement_offsets(geometry, placed_size, axis):
+    # Candidate positions of the image along one axis: the image edges on
+    # every screen edge, plus centered, kept within the wall's bounds (or
+    # spanning them when the image is larger). The overlap with the screen
+    # union is piecewise linear between these, so its maximum is among them.
+    import numpy as np
+
+    left, top, width, height = geometry.bounds()
+    start, length = (left, width) if axis == 0 else (top, height)
+    xs, ys, mask = geometry.union_cells()
+    edges = xs if axis == 0 else ys
+    low, high = sorted((start, start + length - placed_size))
+    candidates = np.concatenate((edges, edges - placed_size, [start + (length - placed_size) / 2]))
+    return np.unique(np.clip(candidates, low, high))
+
+
+def box_blur(values, radius):
+    # Mean over a (2 * radius + 1) square window, edges clamped
+    import numpy as np
+
+    for axis in (0, 1):
+        padded = np.pad(values, [(radius + 1, radius) if a == axis else (0, 0) for a in (0, 1)], mode='edge')
+        sums = np.cumsum(padded, axis=axis)
+        size = values.shape[axis]
+        values = (np.take(sums, range(2 * radius + 1, 2 * radius + 1 + size), axis=axis)
+                  - np.take(sums, range(size), axis=axis)) / (2 * radius + 1)
+    return values
+
+
+def detail_map(proxy):
+    # Where an image has detail worth keeping on screen (text, faces, edges):
+    # gradient energy of a small grayscale copy, blurred into regions, less
+    # the typical level so plain texture does not count
+    import numpy as np
+
+    gray = np.asarray(proxy, dtype=np.float32)
+    if gray.ndim == 3 and gray.shape[2] >= 3:
+        gray = gray[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    elif gray.ndim == 3:
+        gray = gray[..., 0]  # Grayscale with alpha
+    energy = (np.abs(np.diff(gray, axis=1, append=gray[:, -1:]))
+              + np.abs(np.diff(gray, axis=0, append=gray[-1:])))
+    energy = box_blur(energy, max(1, round(max(gray.shape) * DETAIL_BLUR)))
+    return np.clip(energy - np.median(energy), 0, None)
+
+
+def detail_proxy(image_path):
+    # Small grayscale copy of an image for the detail objective; JPEG is
+    # decoded at a reduced scale, and a cached source uses its stored proxy
+    import numpy as np
+    from PIL import Image
+
+    if decode_cache is not None and isinstance(image_path, str) and decode_cache.has(image_path):
+        proxies = source_cache.get(image_path).proxies
+        if proxies:
+            return proxies[-1]
+    with Image.open(image_file(image_path)) as image:
+        image.draft('L', (DETAIL_PROXY_SIDE, DETAIL_PROXY_SIDE))
+        image = image.convert('L')
+    image.thumbnail((DETAIL_PROXY_SIDE, DETAIL_PROXY_SIDE), Image.BOX)
+    return np.asarray(image)
+
+
+def solve_detail_placement(geometry, image_size, proxy):
+    # Cover the screens at a scale between the cover fit and DETAIL_MAX_ZOOM
+    # times it, at the offset that keeps the most image detail on screens
+    # rather than in the gaps between them or off the wall. Detail is
+    # measured on a small proxy only: for every candidate, the detail landing
+    # on each cell of the screen union grid is read from the proxy's integral
+    # image, vectorized over all offsets of a scale at once.
+    import numpy as np
+
+    left, top, width, height = geometry.bounds()
+    image_width, image_height = image_size
+    detail = detail_map(proxy)
+    if detail.sum() <= 0:
+        return solve_placement(geometry, image_size, 'cover')  # Flat image: nothing to protect
+    detail = detail / detail.sum()
+    proxy_h, proxy_w = detail.shape
+    integral = np.zeros((proxy_h + 1, proxy_w + 1))
+    integral[1:, 1:] = detail.cumsum(axis=0).cumsum(axis=1)
+    xs, ys, mask = geometry.union_cells()
+    mask = mask.astype(float)
+
+    def lookup(edges, start, texel, size):
+        # Integral image index and weight of every cell edge, per offset
+        position = np.clip((edges[None, :] - start[:, None]) / texel, 0, size)
+        index = np.minimum(position.astype(int), size - 1)
+        return index, position - index
+
+    cover = max(width / image_width, height / image_height)
+    best = None
+    for scale in np.geomspace(cover, cover * DETAIL_MAX_ZOOM, DETAIL_SCALE_STEPS):
+        placed_w, placed_h = image_width * scale, image_height * scale
+        offsets_x = np.unique(np.round(np.linspace(left + width - placed_w, left, DETAIL_OFFSET_STEPS)))
+        offsets_y = np.unique(np.round(np.linspace(top + height - placed_h, top, DETAIL_OFFSET_STEPS)))
+        col, col_w = lookup(xs, offsets_x, placed_w / proxy_w, proxy_w)
+        row, row_w = lookup(ys, offsets_y, placed_h / proxy_h, proxy_h)
+        # The integral image sampled at the column edges of every x offset,
+        # differenced into columns and summed over the union cells of each
+        # row: [integral row, cell row, offset x]
+        sampled = integral[:, col] * (1 - col_w) + integral[:, col + 1] * col_w
+        rows = np.einsum('ibc,rc->irb', np.diff(sampled, axis=2), mask)
+        # Sampled at the row edges of every y offset, the difference between
+        # a cell row's bottom and top edges is the detail it keeps
+        cell_rows = np.arange(len(ys) - 1)
+
+        def edge(k):
+            index, weight = row[:, k:len(ys) - 1 + k], row_w[:, k:len(ys) - 1 + k, None]
+            return rows[index, cell_rows] * (1 - weight) + rows[index + 1, cell_rows] * weight
+
+        kept = (edge(1) - edge(0)).sum(axis=1)  # [offset y, offset x]
+        # Among nearly equal placements prefer the least zoom, then centered
+        off_center = np.hypot(offsets_x[None, :] + placed_w / 2 - (left + width / 2),
+                              offsets_y[:, None] + placed_h / 2 - (top + height / 2))
+        a, b = np.unravel_index(np.argmax(kept - 1e-6 * off_center), kept.shape)
+        if best is None or kept[a, b] > best[0] + 0.002:
+            best = (kept[a, b], offsets_x[b], offsets_y[a], scale)
+    kept, x, y, scale = best
+    return {'x': int(x), 'y': int(y), 'scale': float(scale)}
+
+
+def solve_placement(geometry, image_size, objective='cover', center=None, proxy=None):
+    # Scale and offset of the image over the screens in one step, in preview
+    # pixels. Objectives:
+    #   cover    - cover every screen with the least source cropped, centered
+    #              on the screen area so larger screens weigh more
+    #   contain  - show the whole image inside the wall, placed so the least
+    #              of it falls in the gaps between screens
+    #   balanced - trade covered screen area against cropped source area
+    #              over the exact screen union
+    #   center   - cover every screen without moving the image center
+    #              (center defaults to the middle of the screens)
+    #   detail   - cover every screen keeping the image's detail off the
+    #              gaps between screens; needs proxy, a small copy of the
+    #              image (see detail_proxy)
+    import numpy as np
+
+    left, top, width, height = geometry.bounds()
+    image_width, image_height = image_size
+    if objective == 'detail':
+        if proxy is None:
+            raise ValueError('the detail objective needs a proxy of the image')
+        placement = solve_detail_placement(geometry, image_size, proxy)
+        x, y, scale = placement['x'], placement['y'], placement['scale']
+    elif objective == 'center':
+        center_x, center_y = center or (left + width / 2, top + height / 2)
+        half_w = max(center_x - left, left + width - center_x)
+        half_h = max(center_y - top, top + height - center_y)
+        scale = max(2 * half_w / image_width, 2 * half_h / image_height)
+        x = center_x - image_width * scale / 2
+        y = center_y - image_height * scale / 2
+    elif objective == 'cover':
+        scale = max(width / image_width, height / image_height)
+        placed_w, placed_h = image_width * scale, image_height * scale
+        center_x, center_y = geometry.union_centroid()
+        x = min(max(center_x - placed_w / 2, left + width - placed_w), left)
+        y = min(max(center_y - placed_h / 2, top + height - placed_h), top)
+    elif objective in ('contain', 'balanced'):
+        contain = min(width / image_width, height / image_height)
+        cover = max(width / image_width, height / image_height)
+        scales = [contain] if objective == 'contain' else np.geomspace(contain, cover, FIT_SCALE_STEPS)
+        rects = []
+        for scale in scales:
+            placed_w, placed_h = image_width * scale, image_height * scale
+            offsets_x = placement_offsets(geometry, placed_w, 0)
+            offsets_y = placement_offsets(geometry, placed_h, 1)
+            grid_x, grid_y = np.meshgrid(offsets_x, offsets_y)
+            rects.append(np.stack([grid_x.ravel(), grid_y.ravel(),
+                                   np.full(grid_x.size, placed_w), np.full(grid_x.size, placed_h),
+                                   np.full(grid_x.size, scale)], axis=1))
+        rects = np.concatenate(rects)
+        covered = geometry.union_overlap(rects[:, :4])
+        # Screen area covered minus source area cropped (off the screens)
+        score = 2 * covered - rects[:, 2] * rects[:, 3]
+        # Among equally good placements take the one closest to centered
+        best = score >= score.max() - 1e-6 * max(1.0, abs(score.max()))
+        off_center = np.hypot(rects[:, 0] + rects[:, 2] / 2 - (left + width / 2),
+                              rects[:, 1] + rects[:, 3] / 2 - (top + height / 2))
+        x, y, placed_w, placed_h, scale = rects[np.argmin(np.where(best, off_center, np.inf))].tolist()
+    else:
+        raise ValueError(f'unknown fit objective {objective!r}')
+    x, y = int(round(x)), int(round(y))
+    if objective in ('cover', 'center', 'detail'):
+        # The whole-pixel position can leave the far edges of the screens a
+        # fraction of a pixel short of the image; scale up to make up for it
+        scale = max(scale, (left + width - x) / image_width, (top + height - y) / image_height)
+    return {'x': x, 'y': y, 'scale': float(scale)}
+
+
+def placed_size(image_size, scale):
+    # Whole preview pixels the image spans at scale, rounded up but ignoring
+    # float error, so a scale solved to span N pixels spans N, not N - 1
+    return tuple(math.ceil(side * scale - PIXEL_EPSILON) for side in image_size)
+
+
+def source_region(box, size, image_size):
+    # Whole source pixels the resample of box to size reads, kernel included
+    margin = math.ceil(LANCZOS_SUPPORT * max(1.0, (box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1])) + 1
+    return (max(0, math.floor(box[0]) - margin), max(0, math.floor(box[1]) - margin),
+            min(image_size[0], math.ceil(box[2]) + margin), min(image_size[1], math.ceil(box[3]) + margin))
+
+
+class DecodedSource:
+    # A fully decoded source held in one NumPy buffer. The Pillow image is a
+    # zero-copy view of that buffer, and the GUI wraps the same buffer in a
+    # QImage, so preview and export never hold separate decoded copies.
+    # Pixels are stored as L, RGBX or RGBA, which both Pillow and Qt can
+    # address in place.
+
+    def __init__(self, pixels, mode, proxies=None, mapped=False):
+        from PIL import Image
+
+        self.pixels = pixels
+        self.mode = mode
+        self.size = (pixels.shape[1], pixels.shape[0])
+        # Pages of a memory-mapped source belong to the OS file cache
+        self.nbytes = 0 if mapped else pixels.nbytes
+        self.image = Image.frombuffer(mode, self.size, pixels, 'raw', mode, 0, 1)
+        # Reduced copies, largest first, stored along with a cached source
+        self.proxies = proxies or []
+
+    @classmethod
+    def decode(cls, image_path):
+        import numpy as np
+        from PIL import Image
+
+        with Image.open(image_path) as image:
+            if image.mode == 'L' or image.mode.startswith('I'):
+                mode = 'L'
+            elif image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                mode = 'RGBA'
+            else:
+                mode = 'RGBX'
+            if image.mode != mode:
+                image = convert_mode(image, mode)
+            pixels = np.asarray(image)
+        return cls(pixels, mode)
+
+
+class SourceCache:
+    # Decoded sources keyed by path, modification time and file size, so an
+    # edited file is decoded again. Least recently used entries are evicted
+    # once the total exceeds memory_limit bytes; the entry just requested is
+    # always kept. Safe to use from export worker threads.
+
+    def __init__(self, memory_limit=2 << 30):
+        self.memory_limit = memory_limit
+        self.entries = OrderedDict()
+        self.decoding = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(image_path):
+        stat = os.stat(image_path)
+        return os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size
+
+    def peek(self, image_path):
+        with self.lock:
+            return self.entries.get(self.key(image_path))
+
+    def get(self, image_path):
+        key = self.key(image_path)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            # Another thread may already be decoding this file; wait for it
+            event = self.decoding.get(key)
+            owner = event is None
+            if owner:
+                event = self.decoding[key] = threading.Event()
+        if not owner:
+            event.wait()
+            return self.get(image_path)
+        try:
+            with tracer.span('decode', path=image_path):
+                source = decode_cache.load(image_path) if decode_cache is not None else None
+                if source is None:
+                    source = DecodedSource.decode(image_path)
+                    if decode_cache is not None:
+                        decode_cache.store(image_path, source)
+            with self.lock:
+                self.entries[key] = source
+                self.evict(keep=key)
+            return source
+        finally:
+            with self.lock:
+                del self.decoding[key]
+            event.set()
+
+    def evict(self, keep):
+        total = sum(source.nbytes for source in self.entries.values())
+        for key in list(self.entries):
+            if total <= self.memory_limit:
+                break
+            if key != keep:
+                total -= self.entries.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Shared by the preview and the export of the running session
+source_cache = SourceCache()
+
+
+class DecodeCache:
+    # Decoded sources kept on disk, keyed by content hash, one directory per
+    # source: pixels.npy, proxy_0.npy, proxy_1.npy, ... and meta.json. Opening
+    # a cached source memory-maps its pixels, so only the pages a crop
+    # touches are read. Entries are written to a temporary directory and
+    # renamed into place, so concurrent processes never see half an entry.
+    # meta.json is touched on every use; once the cache grows past max_bytes
+    # the least recently used entries are removed.
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry_path(self, image_path):
+        return os.path.join(self.directory, source_hash(image_path))
+
+    def has(self, image_path):
+        return os.path.exists(os.path.join(self.entry_path(image_path), 'meta.json'))
+
+    def load(self, image_path):
+        import numpy as np
+
+        entry = self.entry_path(image_path)
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            pixels = np.load(os.path.join(entry, 'pixels.npy'), mmap_mode='r')
+            proxies = [np.load(os.path.join(entry, f'proxy_{level}.npy'), mmap_mode='r')
+                       for level in range(meta['levels'])]
+            os.utime(os.path.join(entry, 'meta.json'))
+        except (OSError, ValueError, KeyError):
+            return None  # Not cached, or removed while being read
+        if (pixels.shape[1], pixels.shape[0]) != tuple(meta['size']):
+            return None
+        return DecodedSource(pixels, meta['mode'], proxies, mapped=True)
+
+    def store(self, image_path, source):
+        import shutil
+
+        import numpy as np
+
+        entry = self.entry_path(image_path)
+        if os.path.exists(entry):
+            return
+        proxies = cache_proxies(source)
+        tmp_entry = f'{entry}.{os.getpid()}-{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(tmp_entry)
+            np.save(os.path.join(tmp_entry, 'pixels.npy'), source.pixels)
+            for level, proxy in enumerate(proxies):
+                np.save(os.path.join(tmp_entry, f'proxy_{level}.npy'), proxy)
+            with open(os.path.join(tmp_entry, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump({'mode': source.mode, 'size': list(source.size), 'levels': len(proxies),
+                           'source': os.path.abspath(image_path) if isinstance(image_path, str) else None}, f)
+            os.rename(tmp_entry, entry)
+        except OSError as e:
+            # Stored by another process meanwhile, or the disk is full: the
+            # source is still usable, just not cached
+            if not os.path.exists(entry):
+                print(f'Decode cache: could not store {image_path}: {e}', file=sys.stderr)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        source.proxies = proxies
+        self.prune(keep=os.path.basename(entry))
+
+    def entries(self):
+        # (last use, bytes, name) of every complete entry, oldest first
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for entry in os.scandir(self.directory):
+            meta_path = os.path.join(entry.path, 'meta.json')
+            if not entry.is_dir() or entry.name.endswith('.tmp') or not os.path.exists(meta_path):
+                continue
+            size = sum(item.stat().st_size for item in os.scandir(entry.path))
+            entries.append((os.stat(meta_path).st_mtime, size, entry.name))
+        return sorted(entries)
+
+    def prune(self, max_bytes=None, keep=None):
+        # Remove least recently used entries until the cache fits in max_bytes
+        # (default: the cap). Returns (entries removed, bytes freed).
+        import shutil
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed, freed = 0, 0
+        for _, size, name in entries:
+            if total <= max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+def cache_proxies(source):
+    # Reduced copies of a source, halving from CACHE_PROXY_MAX_SIDE down to
+    # CACHE_PROXY_MIN_SIDE, so a preview never has to read the full pixels
+    import numpy as np
+    from PIL import Image
+
+    image = source.image
+    long_side = max(image.size)
+    if long_side > CACHE_PROXY_MAX_SIDE:
+        scale = CACHE_PROXY_MAX_SIDE / long_side
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.LANCZOS, reducing_gap=REDUCING_GAP)
+    else:
+        image = image.reduce(2)
+    proxies = []
+    while max(image.size) >= CACHE_PROXY_MIN_SIDE:
+        proxies.append(np.asarray(image))
+        image = image.reduce(2)
+    return proxies
+
+
+def configure_decode_cache(directory=None, max_mb=None):
+    # Enable the decode cache for this process and the worker processes it
+    # starts; without a directory, use the environment's setting, if any
+    global decode_cache
+    if directory:
+        os.environ[DECODE_CACHE_ENV] = directory
+    if max_mb:
+        os.environ[DECODE_CACHE_SIZE_ENV] = str(max_mb)
+    directory = os.environ.get(DECODE_CACHE_ENV)
+    max_mb = int(os.environ.get(DECODE_CACHE_SIZE_ENV, DECODE_CACHE_SIZE_MB))
+    decode_cache = DecodeCache(directory, max_mb * 1024 * 1024) if directory else None
+    return decode_cache
+
+
+decode_cache = None
+configure_decode_cache()
+
+
+def replace_atomically(output_path, write):
+    # write(tmp_path) next to the target, then rename it over the target, so
+    # readers (and sync jobs) never see a half-written file
+    tmp_path = f'{output_path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def make_encoder(format='jpeg', target_bytes=None, **options):
+    # Complete encoder settings: the format's defaults overridden by options.
+    # With target_bytes, the quality is searched per output for the best one
+    # that fits.
+    if format not in ENCODERS:
+        raise ValueError(f"unknown output format '{format}' (expected one of {', '.join(ENCODERS)})")
+    defaults = ENCODERS[format][2]
+    unknown = sorted(set(options) - set(defaults))
+    if unknown:
+        raise ValueError(f"{format} has no option {', '.join(unknown)}")
+    encoder = dict(defaults, **options, format=format, target_bytes=target_bytes or None)
+    if encoder['target_bytes'] and (format == 'png' or encoder.get('lossless')):
+        raise ValueError('a target size needs a lossy format (JPEG, or WebP without lossless)')
+    if format == 'jpeg' and encoder['subsampling'] not in JPEG_SUBSAMPLING:
+        raise ValueError(f"unknown subsampling '{encoder['subsampling']}'")
+    for option, (low, high) in ENCODER_RANGES.items():
+        value = encoder.get(option)
+        # bool is an int subclass; True would pass as 1
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high):
+            raise ValueError(f'{format} {option} must be a whole number from {low} to {high}, not {value!r}')
+    return encoder
+
+
+def encoder_for(output_path):
+    # Default settings of the format implied by the extension; frame
+    # sequence directories hold PNG frames
+    extension = os.path.splitext(output_path)[1].lower()
+    for name, (format_extension, pillow_format, defaults) in ENCODERS.items():
+        if extension == format_extension or (name == 'jpeg' and extension == '.jpeg'):
+            return make_encoder(name)
+    return make_encoder('png')
+
+
+def output_name(idx, encoder):
+    return f'screen_{idx+1}{ENCODERS[encoder["format"]][0]}'
+
+
+def prepare_image(image, encoder):
+    # Convert to a mode the format can store. JPEG has no alpha channel, so
+    # transparency is flattened onto the background colour.
+    from PIL import Image
+
+    transparent = image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in image.info
+    if encoder['format'] == 'jpeg' and transparent:
+        image = image.convert('RGBA')
+        flattened = Image.new('RGB', image.size, encoder['background'])
+        flattened.paste(image, mask=image.getchannel('A'))
+        return flattened
+    if encoder['format'] == 'png' and image.mode in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I;16'):
+        return image
+    if transparent:
+        return image if image.mode == 'RGBA' else image.convert('RGBA')
+    return image if image.mode in ('L', 'RGB') else image.convert('RGB')
+
+
+def encode_image(image, encoder, quality=None):
+    # Encoded bytes of an image already prepared for the format
+    options = {}
+    if encoder['format'] == 'jpeg':
+        options = {
+            'quality': quality or encoder['quality'],
+            'progressive': encoder['progressive'],
+            'optimize': encoder['optimize'],
+            'subsampling': JPEG_SUBSAMPLING[encoder['subsampling']]
+        }
+    elif encoder['format'] == 'png':
+        options = {'compress_level': encoder['compress_level']}
+    elif encoder['format'] == 'webp':
+        options = {'quality': quality or encoder['quality'], 'lossless': encoder['lossless'],
+                   'method': encoder['method']}
+    buffer = io.BytesIO()
+    image.save(buffer, format=ENCODERS[encoder['format']][1], **options)
+    return buffer.getvalue()
+
+
+def encode_to_target(image, encoder):
+    # Bytes of the highest quality that fits in target_bytes. Each round
+    # encodes TRIAL_ENCODES qualities spread over the remaining range at once,
+    # in memory (Pillow releases the GIL while encoding), then narrows the
+    # range to between the best fit and the lowest quality that was too big.
+    # Only the winner is kept.
+    import numpy as np
+
+    target = encoder['target_bytes']
+    low, high = TARGET_QUALITY_RANGE
+    best = None
+    smallest = None
+    with ThreadPoolExecutor(max_workers=TRIAL_ENCODES) as pool:
+        while low <= high:
+            qualities = sorted({int(q) for q in np.linspace(low, high, min(TRIAL_ENCODES, high - low + 1)).round()})
+            trials = list(zip(qualities, pool.map(lambda q: encode_image(image, encoder, q), qualities)))
+            if smallest is None:
+                smallest = trials[0]
+            for quality, data in trials:
+                if len(data) <= target:
+                    best = (quality, data)
+                    low = quality + 1
+                else:
+                    high = quality - 1  # Higher qualities are bigger still
+                    break
+    if best is None:
+        raise ValueError(f'cannot be encoded in {target} bytes '
+                         f'(smallest is {len(smallest[1])} bytes at quality {smallest[0]})')
+    return best[1]
+
+
+def encode_output(image, encoder):
+    # Encoded bytes of any image with complete encoder settings
+    image = prepare_image(image, encoder)
+    return encode_to_target(image, encoder) if encoder['target_bytes'] else encode_image(image, encoder)
+
+
+def save_output(image, output_path, encoder=None):
+    # Encode in memory, then write the file in one go
+    data = encode_output(image, encoder or encoder_for(output_path))
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+    replace_atomically(output_path, write)
+    return output_path
+
+
+def encoder_settings(output_path, encoder=None):
+    # Everything besides the crop that changes an output's bytes
+    return dict(encoder or encoder_for(output_path), resample='lanczos', reducing_gap=REDUCING_GAP)
+
+
+# Content hashes keyed like SourceCache, so a file is hashed once per edit
+source_hashes = {}
+
+
+def source_hash(source):
+    # SHA-256 of a file's bytes, or of every frame of a frame sequence, or
+    # of encoded image bytes given directly
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+    if os.path.isdir(source):
+        digest = hashlib.sha256()
+        for path in frame_paths(source):
+            digest.update(os.path.basename(path).encode('utf-8'))
+            digest.update(source_hash(path).encode('ascii'))
+        return digest.hexdigest()
+    key = SourceCache.key(source)
+    if key not in source_hashes:
+        digest = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        source_hashes[key] = digest.hexdigest()
+    return source_hashes[key]
+
+
+class ExportManifest:
+    # What each output of a directory was rendered from: source content
+    # hash, crop box, output size and encoder settings. plan() drops the
+    # jobs whose output is still there and unchanged; done() records an
+    # output once it has been written, and save() writes the manifest.
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.planned = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.outputs = json.load(f).get('outputs', {})
+        except (OSError, ValueError):
+            self.outputs = {}
+
+    def name(self, output_path):
+        return os.path.relpath(output_path, self.output_dir).replace(os.sep, '/')
+
+    def plan(self, source_hash, jobs, encoder=None):
+        pending = []
+        for box, size, output_path in jobs:
+            name = self.name(output_path)
+            entry = {
+                'source': source_hash,
+                'box': list(box),
+                'size': list(size),
+                'encoder': encoder_settings(output_path, encoder)
+            }
+            if self.outputs.get(name) == entry and os.path.exists(output_path):
+                continue
+            # Forget the old entry until the new output is written, so an
+            # interrupted export is redone next time
+            self.outputs.pop(name, None)
+            self.planned[name] = entry
+            pending.append((box, size, output_path))
+        if pending:
+            self.save()
+        return pending
+
+    def done(self, output_path):
+        name = self.name(output_path)
+        self.outputs[name] = self.planned.pop(name)
+
+    def save(self):
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'outputs': self.outputs}, f, indent=2, sort_keys=True)
+
+        replace_atomically(self.path, write)
+
+
+def render_and_save(image, box, size, output_path, encoder=None):
+    # Resample the float box straight to the output size in one pass, with
+    # an integer reduce() first for large ratios; no full-size crop is made.
+    # Pillow releases the GIL while resampling and encoding, so this runs
+    # well on threads.
+    from PIL import Image
+
+    with tracer.span('crop', output=output_path, size=list(size)):
+        if image.mode in ('1', 'P', 'PA') or image.mode.startswith('I'):
+            # resize() scales palette and bilevel images nearest-neighbour;
+            # convert the screen's region to the mode of the other paths
+            region = source_region(box, size, image.size)
+            mode = frame_mode(image)
+            image = convert_mode(image.crop(region), mode)
+            box = (box[0] - region[0], box[1] - region[1], box[2] - region[0], box[3] - region[1])
+        rendered = image.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+    with tracer.span('encode', output=output_path):
+        return save_output(rendered, output_path, encoder)
+
+
+def render_buffer(image, box, size, encoder):
+    # render_and_save to memory: the encoded bytes of one screen
+    from PIL import Image
+
+    with tracer.span('crop', size=list(size)):
+        rendered = image.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+    with tracer.span('encode', format=encoder['format']):
+        return encode_output(rendered, encoder)
+
+
+def lossless_crops(image_path, jobs, encoder):
+    # Split (box, size, output_path) jobs into those jpegtran can cut from a
+    # JPEG source's compressed data, and those that must be rendered. A
+    # lossless crop needs JPEG output without a target size, no resampling
+    # (the box is whole pixels at the output size) and a top-left corner on
+    # an MCU boundary; the right and bottom edges can fall anywhere.
+    import shutil
+
+    from PIL import Image
+
+    if (encoder is None or encoder['format'] != 'jpeg' or encoder['target_bytes']
+            or shutil.which('jpegtran') is None):
+        return [], jobs
+    with Image.open(image_path) as image:
+        if image.format != 'JPEG':
+            return [], jobs
+        # (component id, horizontal sampling, vertical sampling, quantization table)
+        layers = image.layer
+        width, height = image.size
+    mcu_w = 8 * max(layer[1] for layer in layers) if len(layers) > 1 else 8
+    mcu_h = 8 * max(layer[2] for layer in layers) if len(layers) > 1 else 8
+    crops, renders = [], []
+    for box, size, output_path in jobs:
+        left, upper = round(box[0]), round(box[1])
+        whole = (left, upper, left + size[0], upper + size[1])
+        if (all(abs(edge - exact) <= CROP_TOLERANCE for edge, exact in zip(box, whole))
+                and left % mcu_w == 0 and upper % mcu_h == 0 and whole[2] <= width and whole[3] <= height):
+            crops.append((whole, size, output_path))
+        else:
+            renders.append((box, size, output_path))
+    return crops, renders
+
+
+def crop_jpeg(image_path, box, size, output_path, encoder):
+    # Lossless crop with jpegtran: the DCT coefficients of the covered MCUs
+    # are copied as they are, so nothing is decoded or re-encoded and the
+    # source's quality and subsampling carry over. Metadata is dropped, like
+    # the rendered outputs.
+    import subprocess
+
+    left, upper = box[:2]
+    command = ['jpegtran', '-copy', 'none', '-crop', f'{size[0]}x{size[1]}+{left}+{upper}']
+    if encoder['progressive']:
+        command.append('-progressive')
+    elif encoder['optimize']:
+        command.append('-optimize')
+
+    def write(tmp_path):
+        result = subprocess.run(command + ['-outfile', tmp_path, image_path], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise ValueError(f'jpegtran failed: {result.stderr.strip()}')
+
+    with tracer.span('lossless crop', output=output_path, size=list(size)):
+        replace_atomically(output_path, write)
+    return output_path
+
+
+class BandReader:
+    # Reads a source image as horizontal bands without decoding the whole
+    # image. Uncompressed layouts (BMP, PPM, TGA, raw TIFF strips and tiles)
+    # are read by seeking to the rows of each band. Non-interlaced 8-bit PNG
+    # is inflated as a stream and re-fed to Pillow one band at a time, with
+    # the previous row prepended so row filters can be undone. Any other
+    # format has no row-level access in Pillow and is decoded fully.
+
+    def __init__(self, image_path):
+        from PIL import Image
+
+        self.image = Image.open(image_path)
+        self.size = self.image.size
+        self.mode = self.image.mode
+        # Read the palette without getpalette(), which would decode the image
+        self.palette = self.image.palette.getdata() if self.mode == 'P' else None
+        tiles = self.image.tile
+        if tiles and all(tile[0] == 'raw' and self.raw_args(tile)[0] in RAW_BITS for tile in tiles):
+            self.strategy = 'raw'
+        elif (self.image.format == 'PNG' and len(tiles) == 1 and tiles[0][3] == self.mode
+              and self.mode in PNG_STREAM_MODES and not self.image.info.get('interlace')):
+            self.strategy = 'png'
+        else:
+            self.strategy = 'full'
+
+    @staticmethod
+    def raw_args(tile):
+        args = tile[3]
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+        return rawmode, stride, ystep
+
+    def band_height(self, memory_budget):
+        # Rows per band so that what stream_slice holds at once fits the
+        # budget: the band, the crops of it for every screen and the rows
+        # they are stacked onto, and resize()'s intermediate rows; the PNG
+        # path also holds the inflated rows and a stored copy
+        from PIL import Image
+
+        row_bytes = self.size[0] * len(Image.new(self.mode, (1, 1)).tobytes())
+        copies = 8 if self.strategy == 'png' else 6
+        return max(1, memory_budget // (copies * row_bytes))
+
+    def bands(self, band_height):
+        # Yields (top, band image) pairs covering the image from top to bottom
+        if self.strategy == 'png':
+            yield from self.png_bands(band_height)
+            return
+        if self.strategy == 'full':
+            self.image.load()
+        width, height = self.size
+        for top in range(0, height, band_height):
+            bottom = min(height, top + band_height)
+            if self.strategy == 'raw':
+                yield top, self.raw_band(top, bottom)
+            else:
+                yield top, self.image.crop((0, top, width, bottom))
+
+    def new_band(self, height):
+        from PIL import Image
+
+        band = Image.new(self.mode, (self.size[0], height))
+        if self.palette is not None:
+            band.putpalette(self.palette[1], self.palette[0])
+        return band
+
+    def raw_band(self, top, bottom):
+        from PIL import Image
+
+        band = self.new_band(bottom - top)
+        fp = self.image.fp
+        for tile in self.image.tile:
+            tile_left, tile_top, tile_right, tile_bottom = tile[1]
+            first, last = max(tile_top, top), min(tile_bottom, bottom)
+            if first >= last:
+                continue
+            rawmode, stride, ystep = self.raw_args(tile)
+            tile_width = tile_right - tile_left
+            if stride <= 0:
+                stride = (tile_width * RAW_BITS[rawmode] + 7) // 8
+            # Bottom-up layouts (BMP, TGA) store the last row first
+            if ystep >= 0:
+                fp.seek(tile[2] + (first - tile_top) * stride)
+            else:
+                fp.seek(tile[2] + (tile_bottom - last) * stride)
+            data = fp.read((last - first) * stride)
+            part = Image.frombytes(self.mode, (tile_width, last - first), data, 'raw', rawmode, stride, ystep)
+            band.paste(part, (tile_left, first - top))
+        return band
+
+    def png_chunks(self):
+        # Inflated, still filtered scanline data of all IDAT chunks
+        inflater = zlib.decompressobj()
+        with open(self.image.filename, 'rb') as f:
+            f.read(8)  # PNG signature
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                length = int.from_bytes(header[:4], 'big')
+                chunk_type = header[4:]
+                if chunk_type == b'IDAT':
+                    remaining = length
+                    while remaining:
+                        data = f.read(min(remaining, 1 << 20))
+                        remaining -= len(data)
+                        # Cap the inflated size, highly compressible rows expand a lot
+                        while data:
+                            yield inflater.decompress(data, 1 << 20)
+                            data = inflater.unconsumed_tail
+                    f.read(4)  # CRC
+                elif chunk_type == b'IEND':
+                    break
+                else:
+                    f.seek(length + 4, os.SEEK_CUR)
+        yield inflater.flush()
+
+    def png_bands(self, band_height):
+        from PIL import Image
+
+        width, height = self.size
+        stride = 1 + len(Image.new(self.mode, (width, 1)).tobytes())
+        chunks = self.png_chunks()
+        pending = bytearray()
+        previous_row = None
+        for top in range(0, height, band_height):
+            rows = min(band_height, height - top)
+            while len(pending) < rows * stride:
+                pending += next(chunks)
+            data = bytes(pending[:rows * stride])
+            del pending[:rows * stride]
+            if previous_row is not None:
+                # Unfiltered copy of the row above, so Up/Average/Paeth work
+                data = b'\x00' + previous_row + data
+            decoded = Image.frombytes(self.mode, (width, rows + (previous_row is not None)),
+                                      zlib.compress(data, 0), 'zip', self.mode)
+            if previous_row is not None:
+                decoded = decoded.crop((0, 1, width, rows + 1))
+            if self.palette is not None:
+                decoded.putpalette(self.palette[1], self.palette[0])
+            previous_row = decoded.crop((0, rows - 1, width, rows)).tobytes()
+            yield top, decoded
+
+
+def stack_rows(upper, lower):
+    # One image of the rows of upper followed by those of lower
+    from PIL import Image
+
+    stacked = Image.new(upper.mode, (upper.width, upper.height + lower.height))
+    stacked.paste(upper, (0, 0))
+    stacked.paste(lower, (0, upper.height))
+    return stacked
+
+
+class BandResampler:
+    # The output of one screen, filled band by band while the source is
+    # streamed. Rows of the screen's source region are first reduced by an
+    # integer factor where the output is much smaller (like resize() with
+    # reducing_gap), then kept only until every output row whose Lanczos
+    # window reaches them has been computed. Each call resamples the output
+    # rows that have become complete with resize(box=...), which gives the
+    # same pixels as resampling the whole region at once.
+
+    def __init__(self, region, box, size, mode):
+        from PIL import Image
+
+        import numpy as np
+
+        left, upper, right, lower = region
+        self.width = right - left
+        self.height = lower - upper
+        self.size = size
+        # Alpha is resampled premultiplied, as resize() does
+        self.mode = {'RGBA': 'RGBa', 'LA': 'La'}.get(mode, mode)
+        self.output_mode = mode
+        self.factor = (max(1, int((box[2] - box[0]) / size[0] / REDUCING_GAP)),
+                       max(1, int((box[3] - box[1]) / size[1] / REDUCING_GAP)))
+        factor_x, factor_y = self.factor
+        # Box and region height in reduced pixels
+        self.box = ((box[0] - left) / factor_x, (box[1] - upper) / factor_y,
+                    (box[2] - left) / factor_x, (box[3] - upper) / factor_y)
+        self.reduced_height = -(-self.height // factor_y)
+        self.scale = (self.box[3] - self.box[1]) / size[1]
+        support = LANCZOS_SUPPORT * max(1.0, self.scale)
+        centers = self.box[1] + (np.arange(size[1]) + 0.5) * self.scale
+        # Reduced rows [first, last) each output row reads, as Pillow computes them
+        self.first = np.maximum(0, (centers - support + 0.5).astype(int))
+        self.last = np.minimum(self.reduced_height, (centers + support + 0.5).astype(int))
+        self.output = Image.new(self.mode, size)
+        self.received = 0  # Region rows seen
+        self.pending = None  # Region rows waiting for a whole reduction block
+        self.rows = None  # Reduced rows [rows_top, rows_top + rows.height) still needed
+        self.rows_top = 0
+        self.done = 0  # Output rows computed
+
+    def add(self, part):
+        # Feed the next rows of the region; returns the output image once
+        # its last row is done, else None
+        from PIL import Image
+
+        import numpy as np
+
+        if part.mode != self.mode:
+            part = convert_mode(part, self.mode)
+        self.received += part.height
+        if self.pending is not None:
+            part = stack_rows(self.pending, part)
+            self.pending = None
+        factor_x, factor_y = self.factor
+        if self.received < self.height:
+            usable = part.height // factor_y * factor_y
+            if usable < part.height:
+                self.pending = part.crop((0, usable, part.width, part.height))
+            if usable == 0:
+                return None
+            part = part.crop((0, 0, part.width, usable))
+        if self.factor != (1, 1):
+            part = part.reduce(self.factor)
+        self.rows = part if self.rows is None else stack_rows(self.rows, part)
+        held = self.rows_top + self.rows.height
+        # Output rows whose whole window is held; one spare row keeps
+        # rounding in the partial box from reaching past the held rows
+        limit = held if held == self.reduced_height else held - 1
+        end = int(np.searchsorted(self.last, limit, side='right'))
+        if end > self.done:
+            top = self.box[1] + self.done * self.scale - self.rows_top
+            bottom = self.box[1] + end * self.scale - self.rows_top
+            rendered = self.rows.resize((self.size[0], end - self.done), Image.LANCZOS,
+                                        box=(self.box[0], top, self.box[2], bottom))
+            self.output.paste(rendered, (0, self.done))
+            self.done = end
+        if self.done == self.size[1]:
+            self.rows = None
+            return self.output if self.mode == self.output_mode else self.output.convert(self.output_mode)
+        # Drop the rows no remaining output row reads, again keeping a spare
+        keep = min(held, max(self.rows_top, int(self.first[self.done]) - 1))
+        if keep == held:
+            self.rows = None
+        elif keep > self.rows_top:
+            self.rows = self.rows.crop((0, keep - self.rows_top, self.rows.width, self.rows.height))
+        self.rows_top = keep
+        return None
+
+
+def can_stream(image_path):
+    # Whether stream_slice can read an image in bands (see BandReader)
+    reader = BandReader(image_path)
+    try:
+        return reader.strategy != 'full'
+    finally:
+        reader.image.close()
+
+
+def stream_slice(image_path, jobs, memory_budget, workers=None, on_saved=None, cancel=None, encoder=None):
+    # Render every (box, size, output_path) job while reading the source in
+    # bands sized to memory_budget bytes. Each band is resampled straight
+    # into the output of every screen it crosses (see BandResampler), so
+    # memory stays within the budget plus the output images. A screen is
+    # encoded on a worker thread as soon as its last row is done. Formats
+    # BandReader would have to decode whole are refused; see draft_decode.
+    import numpy as np
+
+    reader = BandReader(image_path)
+    if reader.strategy == 'full':
+        reader.image.close()
+        raise ValueError(f'{image_path}: {reader.image.format} images cannot be read in bands')
+    mode = reader.mode
+    if mode in ('1', 'P', 'PA') or mode.startswith('I'):
+        # Palette images can only be scaled nearest-neighbour, and 16-bit
+        # ones are rendered as 8-bit like on the other paths
+        mode = frame_mode(reader.image)
+    regions = np.array([source_region(box, size, reader.size) for box, size, output_path in jobs],
+                       dtype=int).reshape(-1, 4)
+    resamplers = {}
+    futures = []
+
+    def advance(idx, band, top):
+        left, upper, right, lower = regions[idx].tolist()
+        if idx not in resamplers:
+            box, size, output_path = jobs[idx]
+            resamplers[idx] = BandResampler(regions[idx].tolist(), box, size, mode)
+        part = band.crop((left, max(upper, top) - top, right, min(lower, top + band.height) - top))
+        if part.mode == 'P' and 'transparency' in reader.image.info:
+            part.info['transparency'] = reader.image.info['transparency']
+        return resamplers[idx].add(part)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            for top, band in reader.bands(reader.band_height(memory_budget)):
+                if cancel is not None and cancel.is_set():
+                    break
+                bottom = top + band.height
+                crossing = np.nonzero((regions[:, 3] > top) & (regions[:, 1] < bottom))[0].tolist()
+                # Screens are independent: resample them side by side
+                finished = list(pool.map(lambda idx: advance(idx, band, top), crossing))
+                for idx, output in zip(crossing, finished):
+                    if output is None:
+                        continue
+                    del resamplers[idx]
+                    box, size, output_path = jobs[idx]
+                    future = pool.submit(save_output, output, output_path, encoder)
+                    if on_saved is not None:
+                        future.add_done_callback(lambda f: f.exception() is None and on_saved(f.result()))
+                    futures.append(future)
+                del band  # Before the next band is read
+    finally:
+        reader.image.close()
+    return [future.result() for future in futures]
+
+
+def draft_decode(image_path, jobs, memory_budget):
+    # For sources stream_slice cannot read in bands: open the image as small
+    # as its outputs allow. JPEG is decoded DCT-scaled to 1/2, 1/4 or 1/8 as
+    # long as no output needs more pixels than that keeps. Warns when the
+    # decoded image still exceeds memory_budget. Returns the image and the
+    # jobs with their boxes in its pixels.
+    from PIL import Image
+
+    image = Image.open(image_path)
+    width, height = image.size
+    if image.format == 'JPEG' and jobs:
+        ratio = min(min((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1]) for box, size, output_path in jobs)
+        scale = 1
+        while scale < 8 and ratio >= scale * 2:
+            scale *= 2
+        if scale > 1:
+            image.draft(image.mode, (-(-width // scale), -(-height // scale)))
+    factor_x, factor_y = image.width / width, image.height / height
+    needed = image.width * image.height * len(image.getbands())
+    if needed > memory_budget:
+        print(f'{image_path}: {image.format} images cannot be read in bands; decoding needs about '
+              f'{needed / 1e6:.0f} MB, more than the memory budget', file=sys.stderr, flush=True)
+    jobs = [((box[0] * factor_x, box[1] * factor_y, box[2] * factor_x, box[3] * factor_y), size, output_path)
+            for box, size, output_path in jobs]
+    return image, jobs
+
+
+def draft_slice(image_path, jobs, memory_budget, workers=None, on_saved=None, cancel=None, encoder=None):
+    # stream_slice for sources that cannot be read in bands: the source is
+    # opened with draft_decode and loaded once, before any worker thread
+    # reads it (Pillow's lazy load() is not thread-safe), then every job is
+    # rendered from it on up to workers threads. The image is closed once
+    # the last job is done.
+    image, jobs = draft_decode(image_path, jobs, memory_budget)
+    with image:
+        with tracer.span('decode', path=image_path, draft=list(image.size)):
+            image.load()
+
+        def render(job):
+            box, size, output_path = job
+            if cancel is not None and cancel.is_set():
+                return None
+            output_path = render_and_save(image, box, size, output_path, encoder)
+            if on_saved is not None:
+                on_saved(output_path)
+            return output_path
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            return [path for path in pool.map(render, jobs) if path is not None]
+
+
+def layout_placement(layout, geometry, image_size, image_path):
+    # The layout's saved placement, or a fit with its objective
+    if layout.get('placement'):
+        return layout['placement']
+    objective = layout.get('fit', 'cover')
+    proxy = detail_proxy(image_path) if objective == 'detail' else None
+    return solve_placement(geometry, image_size, objective, proxy=proxy)
+
+
+def parse_resolution(name):
+    # 'native', a name from RESOLUTIONS, or a short side such as '1200' or
+    # '1200p'; returns the short side in pixels, or None for native
+    name = name.strip().lower()
+    if name == 'native':
+        return None
+    if name in RESOLUTIONS:
+        return RESOLUTIONS[name]
+    if name.rstrip('p').isdigit() and int(name.rstrip('p')) > 0:
+        return int(name.rstrip('p'))
+    raise ValueError(f"unknown resolution '{name}' (expected native, {', '.join(RESOLUTIONS)} or a number of pixels)")
+
+
+def resolution_screens(layout_screens, short_side):
+    # Layout screens with their output resolution scaled to short_side pixels
+    # on the short side, keeping each screen's aspect ratio. Screens of
+    # unknown resolution keep the source's pixel scale.
+    if short_side is None:
+        return layout_screens
+    screens = []
+    for screen in layout_screens:
+        width, height = screen.get('resolution') or (0, 0)
+        if width > 0 and height > 0:
+            factor = short_side / min(width, height)
+            screen = dict(screen, resolution=[max(1, round(width * factor)), max(1, round(height * factor))])
+        screens.append(screen)
+    return screens
+
+
+class ReductionPyramid:
+    # A source and its 2x, 4x, 8x... box-filter reductions, each made once,
+    # on first use, and shared by every output resampled from the source.
+    # An output reads the smallest level that still leaves a REDUCING_GAP
+    # ratio for the final Lanczos pass, like resize() with reducing_gap, but
+    # without reducing the same region again for every output.
+
+    def __init__(self, image):
+        self.levels = [image]
+        self.lock = threading.Lock()
+
+    def level(self, index):
+        if index < len(self.levels):
+            return self.levels[index]
+        with self.lock:
+            while len(self.levels) <= index:
+                with tracer.span('reduce', level=len(self.levels)):
+                    self.levels.append(self.levels[-1].reduce(2))
+            return self.levels[index]
+
+    def render(self, box, size):
+        from PIL import Image
+
+        ratio = min((box[2] - box[0]) / size[0], (box[3] - box[1]) / size[1])
+        index = max(0, math.floor(math.log2(ratio / REDUCING_GAP))) if ratio > REDUCING_GAP else 0
+        image = self.level(index)
+        factor = 2 ** index
+        box = (box[0] / factor, box[1] / factor,
+               min(box[2] / factor, image.width), min(box[3] / factor, image.height))
+        return image.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+
+
+class ProfileExport:
+    # Every screen of several layout profiles, each at several output
+    # resolutions, from one decode of the source. profiles are (name,
+    # layout) pairs and resolutions are names for parse_resolution; outputs
+    # go to output_root/<profile>/<resolution>/ with a manifest each, so
+    # unchanged outputs are skipped as with slice_image. Every output is
+    # resampled from one shared ReductionPyramid of the source. encoder,
+    # when given, replaces the encoder of every profile.
+
+    def __init__(self, image_path, profiles, resolutions, output_root, encoder=None):
+        from PIL import Image
+
+        if is_animated(image_path):
+            raise ValueError('animations cannot be exported to several profiles')
+        with Image.open(image_path) as image:
+            image_size = image.size
+        digest = source_hash(image_path)
+        self.image_path = image_path
+        self.jobs = []  # (box, size, output path, encoder) still to render
+        self.manifests = {}  # Output directory: ExportManifest, for those with jobs
+        self.reports = []  # (output directory, 1-based screens outside the image, unchanged outputs)
+        resolutions = [(resolution.strip().lower(), parse_resolution(resolution)) for resolution in resolutions]
+        for name, layout in profiles:
+            geometry = ScreenGeometry.from_layout(layout['screens'])
+            placement = layout_placement(layout, geometry, image_size, image_path)
+            profile_encoder = encoder or make_encoder(**layout.get('encoder', {}))
+            for resolution, short_side in resolutions:
+                output_dir = os.path.join(output_root, name, resolution)
+                screens = ScreenGeometry.from_layout(resolution_screens(layout['screens'], short_side))
+                renders = screens.render_boxes(placement, image_size)
+                jobs = [(box, size, os.path.join(output_dir, output_name(idx, profile_encoder)))
+                        for idx, box, size in renders]
+                os.makedirs(output_dir, exist_ok=True)
+                manifest = ExportManifest(output_dir)
+                pending = manifest.plan(digest, jobs, profile_encoder)
+                if pending:
+                    self.manifests[output_dir] = manifest
+                self.jobs += [(box, size, output_path, profile_encoder) for box, size, output_path in pending]
+                rendered = {idx for idx, box, size in renders}
+                skipped = [idx + 1 for idx in range(len(geometry)) if idx not in rendered]
+                self.reports.append((output_dir, skipped, len(jobs) - len(pending)))
+
+    def run(self, workers=None, on_saved=None, cancel=None):
+        # Render and encode the planned outputs on up to workers threads;
+        # with cancel set, outputs not started yet are dropped. Returns the
+        # written paths.
+        if not self.jobs:
+            return []
+        pyramid = ReductionPyramid(source_cache.get(self.image_path).image)
+
+        def render(job):
+            box, size, output_path, encoder = job
+            if cancel is not None and cancel.is_set():
+                return None
+            with tracer.span('crop', output=output_path, size=list(size)):
+                rendered = pyramid.render(box, size)
+            with tracer.span('encode', output=output_path):
+                save_output(rendered, output_path, encoder)
+            if on_saved is not None:
+                on_saved(output_path)
+            return output_path
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return [path for path in pool.map(render, self.jobs) if path is not None]
+
+    def done(self, output_path):
+        self.manifests[os.path.dirname(output_path)].done(output_path)
+
+    def save(self):
+        for manifest in self.manifests.values():
+            manifest.save()
+
+
+def export_image_profiles(image_path, profiles, resolutions, output_dir, trace=False):
+    # ProfileExport of one image in a worker process. Its outputs are
+    # rendered one after another, as images run side by side, and its
+    # decoded source is dropped once they are done, so a worker holds one
+    # source at a time. Returns the reports, the written paths and, with
+    # trace, the recorded spans.
+    tracer.enabled = trace
+    try:
+        with tracer.span('export profiles', path=image_path):
+            export = ProfileExport(image_path, profiles, resolutions, output_dir)
+            try:
+                written = export.run(1, on_saved=export.done)
+            finally:
+                export.save()
+    finally:
+        source_cache.clear()
+    return export.reports, written, tracer.take() if trace else []
+
+
+def export_profiles(image_paths, profiles, resolutions, output_root, workers=None):
+    # ProfileExport for a batch, one worker process per core as with
+    # slice_many, into output_root/<image name>/<profile>/<resolution>/
+    from concurrent.futures import ProcessPoolExecutor  # Pulls in multiprocessing
+
+    jobs = {}
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for image_path in image_paths:
+            jobs[pool.submit(export_image_profiles, image_path, profiles, resolutions,
+                             output_dir_for(output_root, image_path), tracer.enabled)] = image_path
+        for future in as_completed(jobs):
+            image_path = jobs[future]
+            try:
+                reports, written, events = future.result()
+            except Exception as e:
+                failures += 1
+                print(f'{image_path}: {e}', file=sys.stderr)
+                continue
+            tracer.extend(events)
+            for output_dir, skipped, unchanged in reports:
+                report_slice(output_dir, [path for path in written if os.path.dirname(path) == output_dir], skipped,
+                             unchanged)
+    return failures
+
+
+def image_file(source):
+    # Something Image.open reads: a path, or encoded image bytes
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def decode_source(source):
+    # Decoded pixels of a path or of encoded image bytes, through the caches:
+    # paths are kept in source_cache, and both go through the decode cache
+    # (keyed by content) when it is enabled
+    if isinstance(source, str):
+        return source_cache.get(source)
+    decoded = decode_cache.load(source) if decode_cache is not None else None
+    if decoded is None:
+        with tracer.span('decode', bytes=len(source)):
+            decoded = DecodedSource.decode(io.BytesIO(source))
+        if decode_cache is not None:
+            decode_cache.store(source, decoded)
+    return decoded
+
+
+def slice_buffers(source, layout, placement=None, encoder=None, workers=None):
+    # Library entry point: slice an image for a layout without writing any
+    # file. source is an image path or the encoded bytes of an image; layout
+    # is a layout dict as saved from the GUI (see load_layout). placement
+    # ({'x', 'y', 'scale'}) and encoder (options for make_encoder) override
+    # the layout's. Screens are rendered on up to workers threads.
+    # Returns one dict per screen that overlaps the image, in screen order,
+    # {'screen': 1-based index, 'name', 'width', 'height', 'data': encoded
+    # bytes}, and the 1-based indices of screens outside the image.
+    check_layout(layout)
+    if isinstance(source, (bytearray, memoryview)):
+        source = bytes(source)
+    if is_animated(source):
+        raise ValueError('animations cannot be sliced to buffers; use slice_animation')
+    image = decode_source(source).image
+    geometry = ScreenGeometry.from_layout(layout['screens'])
+    placement = placement or layout_placement(layout, geometry, image.size, source)
+    encoder = make_encoder(**(encoder or layout.get('encoder', {})))
+    renders = geometry.render_boxes(placement, image.size)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        buffers = list(pool.map(lambda render: render_buffer(image, render[1], render[2], encoder), renders))
+    outputs = [{'screen': idx + 1, 'name': output_name(idx, encoder), 'width': size[0], 'height': size[1],
+                'data': data} for (idx, box, size), data in zip(renders, buffers)]
+    rendered = {idx for idx, box, size in renders}
+    return outputs, [idx + 1 for idx in range(len(geometry)) if idx not in rendered]
+
+
+def slice_image(image_path, layout, output_dir, memory_budget=None):
+    # Crop one source image for every screen of the layout. Returns the list
+    # of written files, the 1-based indices of screens outside the image and
+    # the number of outputs left as they were because nothing changed.
+    # With a memory_budget (bytes) the source is streamed in bands.
+    # Animations and frame sequence directories are sliced frame by frame.
+    from PIL import Image
+
+    if is_animated(image_path):
+        return slice_animation(image_path, layout, output_dir, workers=1)
+    with Image.open(image_path) as image:
+        if decode_cache is not None and not memory_budget:
+            image = source_cache.get(image_path).image  # Memory-mapped once cached
+        geometry = ScreenGeometry.from_layout(layout['screens'])
+        placement = layout_placement(layout, geometry, image.size, image_path)
+        os.makedirs(output_dir, exist_ok=True)
+        encoder = make_encoder(**layout.get('encoder', {}))
+        renders = geometry.render_boxes(placement, image.size)
+        jobs = [(box, size, os.path.join(output_dir, output_name(idx, encoder))) for idx, box, size in renders]
+        rendered = {idx for idx, box, size in renders}
+        skipped = [idx + 1 for idx in range(len(geometry)) if idx not in rendered]
+        manifest = ExportManifest(output_dir)
+        pending = manifest.plan(source_hash(image_path), jobs, encoder)
+        crops, renders = lossless_crops(image_path, pending, encoder)
+        try:
+            written = []
+            for box, size, output_path in crops:
+                written.append(crop_jpeg(image_path, box, size, output_path, encoder))
+                manifest.done(output_path)
+            if memory_budget and renders and can_stream(image_path):
+                written += stream_slice(image_path, renders, memory_budget, workers=1, on_saved=manifest.done,
+                                        encoder=encoder)
+            elif memory_budget and renders:
+                written += draft_slice(image_path, renders, memory_budget, workers=1, on_saved=manifest.done,
+                                       encoder=encoder)
+            else:
+                for box, size, output_path in renders:
+                    written.append(render_and_save(image, box, size, output_path, encoder))
+                    manifest.done(output_path)
+        finally:
+            if pending:
+                manifest.save()
+    return written, skipped, len(jobs) - len(pending)
+
+
+def frame_sort_key(path):
+    # Numbered frames sort by number: frame_2 before frame_10
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def frame_paths(source):
+    return sorted(collect_images([source]), key=frame_sort_key)
+
+
+def is_animated(source):
+    # Animated GIF/WebP/APNG files (or bytes) and frame sequence directories
+    from PIL import Image
+
+    if isinstance(source, str) and os.path.isdir(source):
+        return True
+    with Image.open(image_file(source)) as image:
+        return getattr(image, 'is_animated', False)
+
+
+def frame_mode(image):
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        return 'RGBA'
+    return 'L' if image.mode == 'L' or image.mode.startswith('I') else 'RGB'
+
+
+def convert_mode(image, mode):
+    # image.convert(mode), except that 16-bit greyscale (I;16, I) is scaled
+    # to 8 bits instead of being clipped at 255
+    if image.mode.startswith('I') and not mode.startswith('I'):
+        image = image.convert('I').point(lambda value: value / 256).convert('L')
+    return image.convert(mode)
+
+
+def exif_thumbnail(image_path):
+    # The JPEG thumbnail cameras embed in the EXIF data (IFD1), or None when
+    # there is none or it is cropped to another aspect ratio than the image
+    from PIL import ExifTags, Image
+
+    with Image.open(image_path) as image:
+        exif_data = image.info.get('exif')
+        if not exif_data:
+            return None
+        width, height = image.size
+        ifd1 = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+    offset, length = ifd1.get(0x0201), ifd1.get(0x0202)  # JPEGInterchangeFormat(Length)
+    if not offset or not length:
+        return None
+    # Offsets count from the TIFF header, after the APP1 'Exif' prefix
+    tiff = exif_data[6:] if exif_data.startswith(b'Exif\x00\x00') else exif_data
+    data = tiff[offset:offset + length]
+    if len(data) != length or not data.startswith(b'\xff\xd8'):
+        return None
+    with Image.open(io.BytesIO(data)) as thumbnail:
+        thumb_width, thumb_height = thumbnail.size
+    if abs(thumb_width / thumb_height - width / height) > 0.02 * width / height:
+        return None
+    return data
+
+
+def animation_info(source):
+    # Frame size, frame count and loop count, read without decoding frames
+    from PIL import Image
+
+    if os.path.isdir(source):
+        paths = frame_paths(source)
+        if not paths:
+            raise ValueError(f'{source} holds no frames')
+        with Image.open(paths[0]) as image:
+            return image.size, len(paths), 0
+    with Image.open(source) as image:
+        return image.size, getattr(image, 'n_frames', 1), image.info.get('loop', 0)
+
+
+def iter_frames(source):
+    # Yield (frame, duration in ms) one decoded frame at a time. Every frame
+    # is an independent copy in the first frame's mode, so it can be
+    # rendered while the decoder moves on to the next one.
+    from PIL import Image, ImageSequence
+
+    if os.path.isdir(source):
+        mode = None
+        for path in frame_paths(source):
+            with Image.open(path) as image:
+                mode = mode or frame_mode(image)
+                yield convert_mode(image, mode), image.info.get('duration', 0)
+        return
+    with Image.open(source) as image:
+        mode = None
+        for frame in ImageSequence.Iterator(image):
+            mode = mode or frame_mode(frame)
+            yield convert_mode(frame, mode), frame.info.get('duration', 0)
+
+
+def slice_frames(source, jobs, workers=None, window=FRAME_WINDOW, on_frame=None, cancel=None):
+    # Render every (box, size, screen_dir) job for each frame of source,
+    # writing screen_dir/frame_00001.png and so on. Frames are decoded on
+    # this thread while the screens of earlier frames are encoded in
+    # parallel on the pool; once window frames are in flight the decoder
+    # waits for the oldest, so memory does not grow with the clip length.
+    # Returns the frame durations in milliseconds.
+    from collections import deque
+
+    for box, size, screen_dir in jobs:
+        os.makedirs(screen_dir, exist_ok=True)
+    durations = []
+    in_flight = deque()
+
+    def retire_oldest():
+        for future in in_flight.popleft():
+            future.result()
+        if on_frame is not None:
+            on_frame()
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for index, (frame, duration) in enumerate(iter_frames(source)):
+            if cancel is not None and cancel.is_set():
+                break
+            while len(in_flight) >= window:
+                retire_oldest()
+            name = f'frame_{index+1:05d}.png'
+            in_flight.append([pool.submit(render_and_save, frame, box, size, os.path.join(screen_dir, name))
+                              for box, size, screen_dir in jobs])
+            durations.append(duration)
+            del frame
+        while in_flight:
+            retire_oldest()
+    return durations
+
+
+def save_frame_timing(output_dir, durations, loop=0):
+    # Frame timing shared by every screen's sequence, for reassembling clips
+    with open(os.path.join(output_dir, 'frames.json'), 'w', encoding='utf-8') as f:
+        json.dump({'durations': durations, 'loop': loop}, f, indent=2)
+
+
+def slice_animation(source, layout, output_dir, workers=None):
+    # Slice an animation or frame sequence into one numbered frame sequence
+    # per screen (output_dir/screen_1/frame_00001.png, ...) plus frames.json
+    size, frame_count, loop = animation_info(source)
+    geometry = ScreenGeometry.from_layout(layout['screens'])
+    placement = layout_placement(layout, geometry, size, frame_paths(source)[0] if os.path.isdir(source) else source)
+    os.makedirs(output_dir, exist_ok=True)
+    renders = geometry.render_boxes(placement, size)
+    jobs = [(box, size, os.path.join(output_dir, f'screen_{idx+1}')) for idx, box, size in renders]
+    rendered = {idx for idx, box, size in renders}
+    skipped = [idx + 1 for idx in range(len(geometry)) if idx not in rendered]
+    manifest = ExportManifest(output_dir)
+    pending = manifest.plan(source_hash(source), jobs)
+    if pending:
+        durations = slice_frames(source, pending, workers)
+        save_frame_timing(output_dir, durations, loop)
+        for box, size, screen_dir in pending:
+            manifest.done(screen_dir)
+        manifest.save()
+    return [screen_dir for box, size, screen_dir in pending], skipped, len(jobs) - len(pending)
+
+
+def collect_images(inputs):
+    # Expand directories to the images they contain, keeping files as given
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for name in sorted(os.listdir(item)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(item, name))
+        else:
+            paths.append(item)
+    return paths
+
+
+def output_dir_for(output_root, image_path):
+    # Every image goes to its own directory named after the source file,
+    # extension included (photo.jpg -> photo_jpg), so photo.jpg and
+    # photo.png never share outputs; frame sequence directories keep their
+    # name
+    name = os.path.basename(os.path.normpath(image_path))
+    stem, extension = os.path.splitext(name)
+    if extension and not os.path.isdir(image_path):
+        name = f'{stem}_{extension[1:]}'
+    return os.path.join(output_root, name)
+
+
+def distinct_outputs(image_paths, output_root):
+    # The images of a batch without repeats; raises ValueError when two
+    # different images would be written to the same directory (same file
+    # name in different folders), as their workers would overwrite each
+    # other's outputs and manifest
+    sources = {}
+    distinct = []
+    for image_path in image_paths:
+        output_dir = os.path.normcase(os.path.abspath(output_dir_for(output_root, image_path)))
+        other = sources.get(output_dir)
+        if other is None:
+            sources[output_dir] = image_path
+            distinct.append(image_path)
+        elif not os.path.samefile(other, image_path):
+            raise ValueError(f'{other} and {image_path} would both be written to '
+                             f'{output_dir_for(output_root, image_path)}; slice them to different --output folders')
+    return distinct
+
+
+def traced_slice_image(*args):
+    # slice_image in a worker process, handing its spans back with the result
+    tracer.enabled = True
+    with tracer.span('slice image', path=args[0]):
+        result = slice_image(*args)
+    return result, tracer.take()
+
+
+def slice_many(image_paths, layout, output_root, workers=None, memory_budget=None):
+    # One worker process per core, one output directory per image
+    from concurrent.futures import ProcessPoolExecutor  # Pulls in multiprocessing
+
+    jobs = {}
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for image_path in image_paths:
+            task = traced_slice_image if tracer.enabled else slice_image
+            jobs[pool.submit(task, image_path, layout, output_dir_for(output_root, image_path), memory_budget)] = image_path
+        for future in as_completed(jobs):
+            image_path = jobs[future]
+            try:
+                result = future.result()
+                if tracer.enabled:
+                    result, events = result
+                    tracer.extend(events)
+                written, skipped, unchanged = result
+            except Exception as e:
+                failures += 1
+                print(f'{image_path}: {e}', file=sys.stderr)
+                continue
+            report_slice(image_path, written, skipped, unchanged)
+    return failures
+
+
+def report_slice(image_path, written, skipped, unchanged):
+    for idx in skipped:
+        print(f'{image_path}: screen {idx} is outside the image boundaries.', file=sys.stderr)
+    print(f'{image_path}: {len(written)} screen(s) exported' + (f', {unchanged} unchanged' if unchanged else ''),
+          flush=True)
+
+
+class WatchJournal:
+    # Append-only record of the images the watcher has sliced, keyed by path
+    # and file signature (modification time and size), so a restarted
+    # watcher skips what it already finished. Failures are logged too but
+    # retried after a restart.
+
+    def __init__(self, output_root):
+        self.path = os.path.join(output_root, JOURNAL_NAME)
+        self.done = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Cut short by a crash
+                    if entry.get('status') == 'done':
+                        self.done[entry['path']] = entry['signature']
+        self.compact()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def compact(self):
+        # Keep only the latest finished entry of each image
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for path, signature in self.done.items():
+                    f.write(json.dumps({'path': path, 'signature': signature, 'status': 'done'}) + '\n')
+
+        replace_atomically(self.path, write)
+
+    def is_done(self, path, signature):
+        return self.done.get(path) == list(signature)
+
+    def record(self, path, signature, status, **details):
+        entry = {'path': path, 'signature': list(signature), 'status': status,
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **details}
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if status == 'done':
+            self.done[path] = list(signature)
+
+    def close(self):
+        self.file.close()
+
+
+def scan_folder(folder):
+    # {absolute path: (modification time in ns, size)} of the images in folder
+    images = {}
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS) and not entry.name.startswith('.'):
+            stat = entry.stat()
+            images[os.path.abspath(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+    return images
+
+
+def watch_folder(folder, layout, output_root, workers=None, memory_budget=None, interval=2.0, settle=2.0,
+                 once=False):
+    # Slice every new or changed image of folder with the layout, polling
+    # every interval seconds. A file is picked up once it has stopped
+    # changing for settle seconds, so an image being copied or rewritten in
+    # quick succession is sliced once. At most workers images are handed to
+    # the process pool at a time; the rest wait in a queue. With once, stop
+    # when nothing is left to do. Returns the number of images that failed.
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    os.makedirs(output_root, exist_ok=True)
+    workers = workers or os.cpu_count()
+    journal = WatchJournal(output_root)
+    changing = {}  # path -> (signature, when it was first seen with it)
+    queue = deque()
+    busy = set()  # Paths queued or being sliced
+    running = {}
+    failed = {}  # path -> signature that failed during this run
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                now = time.monotonic()
+                current = scan_folder(folder)
+                for path in list(changing):
+                    if path not in current:
+                        del changing[path]
+                for path, signature in current.items():
+                    if journal.is_done(path, signature) or failed.get(path) == signature or path in busy:
+                        continue
+                    seen = changing.get(path)
+                    if seen is None or seen[0] != signature:
+                        seen = changing[path] = (signature, now)
+                    # Settled: unchanged for settle seconds while watched, or
+                    # last written that long ago
+                    if now - seen[1] >= settle or time.time() - signature[0] / 1e9 >= settle:
+                        del changing[path]
+                        queue.append((path, signature))
+                        busy.add(path)
+
+                while queue and len(running) < workers:
+                    path, signature = queue.popleft()
+                    future = pool.submit(slice_image, path, layout, output_dir_for(output_root, path), memory_budget)
+                    running[future] = (path, signature)
+
+                if not running:
+                    if once and not changing:
+                        break
+                    time.sleep(interval)
+                    continue
+                finished, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path, signature = running.pop(future)
+                    busy.discard(path)
+                    try:
+                        written, skipped, unchanged = future.result()
+                    except Exception as e:
+                        print(f'{path}: {e}', file=sys.stderr, flush=True)
+                        failed[path] = signature
+                        journal.record(path, signature, 'failed', error=str(e))
+                        continue
+                    report_slice(path, written, skipped, unchanged)
+                    journal.record(path, signature, 'done', written=len(written), unchanged=unchanged)
+    finally:
+        journal.close()
+    return len(failed)
+
+
+def warm_worker(cache_bytes):
+    # Load the decoding stack in a service worker before its first request,
+    # and give its source cache its share of the service's cache size
+    import numpy  # noqa: F401
+    from PIL import Image
+
+    Image.init()
+    source_cache.memory_limit = cache_bytes
+
+
+def service_slice(request):
+    # One /slice request, in a service worker process
+    source = request.get('image') or request['path']
+    return slice_buffers(source, request['layout'], request.get('placement'), request.get('encoder'))
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, workers=None, cache_mb=SERVICE_CACHE_MB):
+    # Local HTTP slicing service. Worker processes are started once and kept
+    # warm, with their own source cache and the shared decode cache, so a
+    # request pays neither interpreter startup nor, for a source seen
+    # before, its decode. cache_mb is split evenly between the workers'
+    # source caches, so it bounds the decoded sources the service keeps.
+    #   POST /slice  JSON {"layout": {...}, "path": "..." or "image": base64,
+    #                "placement": {...}, "encoder": {...}} (the last two
+    #                optional). Replies {"screens": [{"screen", "name",
+    #                "width", "height", "data": base64}], "skipped": [...]},
+    #                or {"error": ...} with status 400 for a bad request.
+    #   GET /health  {"workers": n, "cache_mb": per worker, "decode_cache":
+    #                directory or null}
+    import binascii
+    from concurrent.futures import ProcessPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    workers = workers or os.cpu_count()
+    cache_bytes = cache_mb * 1024 * 1024 // workers
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=warm_worker, initargs=(cache_bytes,))
+    for future in [pool.submit(os.getpid) for _ in range(workers)]:
+        future.result()  # Start every worker now rather than on the first requests
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.reply(404, {'error': f'no such endpoint {self.path}'})
+            self.reply(200, {'workers': workers, 'cache_mb': cache_bytes // (1024 * 1024),
+                             'decode_cache': decode_cache.directory if decode_cache else None})
+
+        def do_POST(self):
+            if self.path != '/slice':
+                return self.reply(404, {'error': f'no such endpoint {self.path}'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if request.get('image'):
+                    request['image'] = base64.b64decode(request['image'], validate=True)
+                elif not request.get('path'):
+                    raise ValueError("the request needs a 'path' or an 'image'")
+                outputs, skipped = pool.submit(service_slice, request).result()
+            except KeyError as e:
+                return self.reply(400, {'error': f'missing {e}'})
+            except (ValueError, TypeError, OSError, binascii.Error) as e:
+                return self.reply(400, {'error': str(e)})
+            except Exception as e:
+                return self.reply(500, {'error': str(e)})
+            for output in outputs:
+                output['data'] = base64.b64encode(output['data']).decode('ascii')
+            self.reply(200, {'screens': outputs, 'skipped': skipped})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'Serving on http://{host}:{server.server_port} with {workers} workers (Ctrl+C to stop)', flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.shutdown(cancel_futures=True)
+
+
+def diagnose(install=False):
+    # Report the modules ScreenSlicer needs, optionally installing the missing ones
+    import importlib.metadata
+    import importlib.util
+    import platform
+
+    print(f'Python     {platform.python_version()} ({sys.executable})')
+    missing = []
+    for module, pip_name in REQUIRED_MODULES.items():
+        if importlib.util.find_spec(module) is None:
+            print(f'{module:<10} missing (pip install {pip_name})')
+            missing.append(pip_name)
+            continue
+        try:
+            version = importlib.metadata.version(pip_name)
+        except importlib.metadata.PackageNotFoundError:
+            version = 'unknown version'
+        print(f'{module:<10} {version}')
+    if missing and install:
+        import subprocess
+
+        print(f"Installing {' '.join(missing)}...")
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing])
+        return 0
+    return 1 if missing else 0
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='ScreenSlicer.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    slice_parser = commands.add_parser('slice', help='slice images without the GUI')
+    slice_parser.add_argument('--layout', required=True, action='append',
+                              help='layout JSON saved from the GUI; repeat to export several profiles')
+    slice_parser.add_argument('--resolutions', default=None, metavar='LIST',
+                              help=f"export every layout at these comma-separated output resolutions: native, "
+                                   f"{', '.join(RESOLUTIONS)} or a short side in pixels")
+    slice_parser.add_argument('--output', default='.', help='output directory (default: current directory)')
+    slice_parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    slice_parser.add_argument('--memory-budget', type=int, default=None, metavar='MB',
+                              help='stream each source in bands using about MB megabytes per worker')
+    slice_parser.add_argument('--fit', choices=FIT_OBJECTIVES, default=None,
+                              help='placement objective when the layout has no image placement (default: cover)')
+    slice_parser.add_argument('--format', choices=ENCODERS, default=None,
+                              help="output format (default: the layout's, else jpeg)")
+    slice_parser.add_argument('--quality', type=int, default=None, help='JPEG/WebP quality, 1-100')
+    slice_parser.add_argument('--progressive', action='store_true', help='write progressive JPEGs')
+    slice_parser.add_argument('--subsampling', choices=JPEG_SUBSAMPLING, default=None, help='JPEG chroma subsampling')
+    slice_parser.add_argument('--lossless', action='store_true', help='write lossless WebP')
+    slice_parser.add_argument('--target-size', type=int, default=None, metavar='KB',
+                              help='search each screen for the best quality that fits in KB kilobytes')
+    slice_parser.add_argument('--decode-cache', default=None, metavar='DIR',
+                              help=f'keep decoded sources in DIR to skip decoding them next time (or set {DECODE_CACHE_ENV})')
+    slice_parser.add_argument('--frames', action='store_true',
+                              help='treat each directory as one numbered frame sequence')
+    slice_parser.add_argument('--trace', default=None, metavar='PATH',
+                              help='write timing spans as a Chrome/Perfetto trace JSON file')
+    slice_parser.add_argument('images', nargs='+', help='image files or directories of images')
+
+    watch_parser = commands.add_parser('watch', help='slice new or changed images of a folder as they arrive')
+    watch_parser.add_argument('--layout', required=True, help='layout JSON saved from the GUI')
+    watch_parser.add_argument('--output', default='.', help='output directory (default: current directory)')
+    watch_parser.add_argument('--fit', choices=FIT_OBJECTIVES, default=None,
+                              help="fit every image with this objective instead of the layout's placement")
+    watch_parser.add_argument('--workers', type=int, default=None,
+                              help='images sliced at once (default: one per core)')
+    watch_parser.add_argument('--memory-budget', type=int, default=None, metavar='MB',
+                              help='stream each source in bands using about MB megabytes per worker')
+    watch_parser.add_argument('--format', choices=ENCODERS, default=None,
+                              help="output format (default: the layout's, else jpeg)")
+    watch_parser.add_argument('--quality', type=int, default=None, help='JPEG/WebP quality, 1-100')
+    watch_parser.add_argument('--progressive', action='store_true', help='write progressive JPEGs')
+    watch_parser.add_argument('--subsampling', choices=JPEG_SUBSAMPLING, default=None, help='JPEG chroma subsampling')
+    watch_parser.add_argument('--lossless', action='store_true', help='write lossless WebP')
+    watch_parser.add_argument('--target-size', type=int, default=None, metavar='KB',
+                              help='search each screen for the best quality that fits in KB kilobytes')
+    watch_parser.add_argument('--decode-cache', default=None, metavar='DIR',
+                              help=f'keep decoded sources in DIR to skip decoding them next time (or set {DECODE_CACHE_ENV})')
+    watch_parser.add_argument('--interval', type=float, default=2.0, help='seconds between scans (default: 2)')
+    watch_parser.add_argument('--settle', type=float, default=2.0,
+                              help='seconds a file must stay unchanged before it is sliced (default: 2)')
+    watch_parser.add_argument('--once', action='store_true', help='exit once the folder has been processed')
+    watch_parser.add_argument('folder', help='folder to watch')
+
+    serve_parser = commands.add_parser('serve', help='slice images over HTTP for programs on this machine')
+    serve_parser.add_argument('--host', default=SERVICE_HOST, help=f'address to listen on (default: {SERVICE_HOST})')
+    serve_parser.add_argument('--port', type=int, default=SERVICE_PORT, help=f'port (default: {SERVICE_PORT})')
+    serve_parser.add_argument('--workers', type=int, default=None,
+                              help='warm worker processes (default: one per core)')
+    serve_parser.add_argument('--cache-size', type=int, default=SERVICE_CACHE_MB, metavar='MB',
+                              help=f'memory for decoded sources, shared by all workers (default: {SERVICE_CACHE_MB})')
+    serve_parser.add_argument('--decode-cache', default=None, metavar='DIR',
+                              help=f'keep decoded sources in DIR between requests (or set {DECODE_CACHE_ENV})')
+
+    diagnose_parser = commands.add_parser('diagnose', help='check the required modules')
+    diagnose_parser.add_argument('--install', action='store_true', help='pip install missing modules')
+
+    cache_parser = commands.add_parser('cache', help='prune the decode cache')
+    cache_parser.add_argument('--dir', default=None, help=f'cache directory (default: ${DECODE_CACHE_ENV})')
+    cache_parser.add_argument('--max-size', type=int, default=None, metavar='MB',
+                              help=f'shrink the cache to MB megabytes (default: ${DECODE_CACHE_SIZE_ENV} '
+                                   f'or {DECODE_CACHE_SIZE_MB})')
+    cache_parser.add_argument('--clear', action='store_true', help='remove every entry')
+
+    args = parser.parse_args(argv)
+    if args.command == 'diagnose':
+        return diagnose(args.install)
+    if args.command == 'cache':
+        cache = configure_decode_cache(args.dir)
+        if cache is None:
+            parser.error(f'no cache directory: pass --dir or set {DECODE_CACHE_ENV}')
+        max_bytes = 0 if args.clear else args.max_size * 1024 * 1024 if args.max_size is not None else None
+        removed, freed = cache.prune(max_bytes)
+        entries = cache.entries()
+        print(f'Removed {removed} entries ({freed / 1e6:.0f} MB); {len(entries)} left '
+              f'({sum(size for _, size, _ in entries) / 1e6:.0f} MB) in {cache.directory}')
+        return 0
+    if args.decode_cache:
+        configure_decode_cache(args.decode_cache)
+    if args.command == 'serve':
+        if args.cache_size < 1:
+            parser.error('--cache-size must be at least 1 MB')
+        try:
+            serve(args.host, args.port, args.workers, args.cache_size)
+        except KeyboardInterrupt:
+            print('Stopped.')
+        return 0
+
+    layout_paths = args.layout if args.command == 'slice' else [args.layout]
+    layouts = [load_layout(layout_path) for layout_path in layout_paths]
+    options = {'quality': args.quality, 'subsampling': args.subsampling, 'target_bytes':
+               args.target_size * 1024 if args.target_size else None}
+    options.update(progressive=True if args.progressive else None, lossless=True if args.lossless else None)
+    for layout in layouts:
+        if args.fit:
+            layout['fit'] = args.fit
+        encoder = layout.get('encoder', {})
+        if args.format and args.format != encoder.get('format', 'jpeg'):
+            encoder = {'format': args.format}  # The layout's options belong to its format
+        encoder.update({key: value for key, value in options.items() if value is not None})
+        try:
+            layout['encoder'] = make_encoder(**encoder)
+        except (TypeError, ValueError) as e:
+            parser.error(str(e))
+    layout = layouts[0]
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+    if args.command == 'watch':
+        if args.fit:
+            layout.pop('placement', None)  # A saved placement only suits the image it was made for
+        print(f'Watching {args.folder} (Ctrl+C to stop)', flush=True)
+        try:
+            failures = watch_folder(args.folder, layout, args.output, args.workers, memory_budget, args.interval,
+                                    args.settle, args.once)
+        except KeyboardInterrupt:
+            print('Stopped.')
+            return 0
+        return 1 if failures else 0
+
+    image_paths = args.images if args.frames else collect_images(args.images)
+    if not image_paths:
+        print('No images to slice.', file=sys.stderr)
+        return 1
+    try:
+        image_paths = distinct_outputs(image_paths, args.output)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    tracer.enabled = bool(args.trace)
+    if len(layouts) > 1 or args.resolutions:
+        # Several profiles or resolutions: each image is decoded once for all of them
+        resolutions = (args.resolutions or 'native').split(',')
+        names = [os.path.splitext(os.path.basename(layout_path))[0] for layout_path in layout_paths]
+        try:
+            for resolution in resolutions:
+                parse_resolution(resolution)
+        except ValueError as e:
+            parser.error(str(e))
+        if len(set(names)) < len(names):
+            parser.error('layout files need different names; they name the output folders')
+        if memory_budget or args.frames:
+            parser.error('--memory-budget and --frames cannot be combined with several layouts or --resolutions')
+        failures = export_profiles(image_paths, list(zip(names, layouts)), resolutions, args.output, args.workers)
+    else:
+        failures = slice_many(image_paths, layout, args.output, args.workers, memory_budget)
+    if args.trace:
+        tracer.save(args.trace)
+    return 1 if failures else 0